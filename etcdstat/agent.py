@@ -0,0 +1,34 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import module
+
+class Agent(module.BaseModule):
+
+    """
+    * {{effective_interval}} - the default poll interval (sec), as stretched
+      while etcd is slow or failing
+    """
+
+    def __init__(self, etcdstat):
+        self.etcdstat = etcdstat
+
+    def keys(self):
+        return ["effective_interval"]
+
+    def get(self, key):
+        if key == "effective_interval":
+            return self.etcdstat.effective_interval
+        else:
+            raise KeyError(key)
@@ -17,21 +17,26 @@ import module
 
 class Disk(module.BaseModule):
 
+    probes = ("disk_usage_pct", "available_storage", "total_storage")
+
     def keys(self):
         return ["disk_usage_pct", "available_storage", "total_storage"]
 
+    def disk_usage(self, path):
+        return self.sample(("disk_usage", path), psutil.disk_usage, path)
+
     def get(self, key):
         if key == "disk_usage_pct":
             def disk_usage(path):
-                return float(psutil.disk_usage(path).percent)/100
+                return float(self.disk_usage(path).percent)/100
             return disk_usage
         elif key == "available_storage":
             def available_storage(path):
-                return psutil.disk_usage(path).free
+                return self.disk_usage(path).free
             return available_storage    
         elif key == "total_storage":
             def total_storage(path):
-                return psutil.disk_usage(path).total
+                return self.disk_usage(path).total
             return total_storage    
         else:
             raise KeyError()
\ No newline at end of file
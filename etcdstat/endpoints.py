@@ -0,0 +1,98 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import socket
+import threading
+import time
+import psutil
+
+def _is_local(hostname):
+    try:
+        addresses = set(info[4][0] for info in socket.getaddrinfo(hostname, None))
+    except socket.error:
+        return False
+    local = set(addr.address.split("%")[0]
+        for addrs in psutil.net_if_addrs().itervalues() for addr in addrs)
+    return bool(addresses & local)
+
+class Endpoint(object):
+
+    def __init__(self, host):
+        self.host = host
+        self.local = _is_local(host[0])
+        self.latency = None
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0
+
+class EndpointSelector(object):
+
+    """
+    Orders the etcd endpoints by preference: the endpoints whose circuit
+    is closed come first, fastest first (by the moving average of the
+    request latency, with the local member's latency halved). An endpoint
+    failing `threshold` times in a row is put last for `cooldown` seconds,
+    doubling on every consecutive trip up to `max_cooldown`; after that
+    one request is let through to probe it.
+    """
+
+    def __init__(self, hosts, alpha=0.3, threshold=3, cooldown=5, max_cooldown=60):
+        self.endpoints = { host : Endpoint(host) for host in hosts }
+        self.alpha = alpha
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.lock = threading.Lock()
+
+    def score(self, endpoint):
+        # endpoints that haven't been measured yet are tried first
+        if endpoint.latency is None:
+            return 0
+        return endpoint.latency / 2 if endpoint.local else endpoint.latency
+
+    def ordered(self):
+        now = time.time()
+        with self.lock:
+            closed = [e for e in self.endpoints.itervalues() if e.open_until <= now]
+            opened = [e for e in self.endpoints.itervalues() if e.open_until > now]
+            closed.sort(key=self.score)
+            opened.sort(key=lambda e: e.open_until)
+            return [e.host for e in closed + opened]
+
+    def success(self, host, latency):
+        with self.lock:
+            endpoint = self.endpoints[host]
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency += self.alpha * (latency - endpoint.latency)
+            endpoint.failures = 0
+            endpoint.trips = 0
+            endpoint.open_until = 0
+
+    def failure(self, host):
+        with self.lock:
+            endpoint = self.endpoints[host]
+            if endpoint.open_until > time.time():
+                # tried as the last resort while its circuit is open
+                return
+            endpoint.failures += 1
+            if endpoint.failures >= self.threshold:
+                cooldown = min(self.cooldown * 2 ** endpoint.trips, self.max_cooldown)
+                endpoint.trips += 1
+                # half-open: the next failure trips the circuit again
+                endpoint.failures = self.threshold - 1
+                endpoint.open_until = time.time() + cooldown
+                logging.warning("etcd endpoint %s:%d is failing, skipping it for %d sec" % (host[0], host[1], cooldown))
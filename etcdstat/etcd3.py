@@ -0,0 +1,144 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import base64
+import json
+import logging
+import time
+import urllib3
+import endpoints
+
+class Etcd3Exception(Exception):
+    pass
+
+class Etcd3ConnectionFailed(Etcd3Exception):
+    pass
+
+def _encode(s):
+    if isinstance(s, unicode):
+        s = s.encode("utf-8")
+    return base64.b64encode(s)
+
+def _decode(s):
+    return base64.b64decode(s).decode("utf-8")
+
+def _prefix_end(prefix):
+    if isinstance(prefix, unicode):
+        prefix = prefix.encode("utf-8")
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class Etcd3(object):
+
+    """
+    Minimal client of the etcd v3 JSON gateway (see
+    https://coreos.com/etcd/docs/latest/dev-guide/api_grpc_gateway.html).
+    Only the calls needed by etcdstat are implemented.
+    """
+
+    def __init__(self, hosts, protocol, cert=None, ca_cert=None, prefix="/v3", timeout=5, pool_size=10):
+        kw = {}
+        if ca_cert:
+            kw["cert_reqs"] = "CERT_REQUIRED"
+            kw["ca_certs"] = ca_cert
+        if isinstance(cert, tuple):
+            kw["cert_file"], kw["key_file"] = cert
+        elif cert:
+            kw["cert_file"] = cert
+        self.http = urllib3.PoolManager(num_pools=10, maxsize=pool_size, **kw)
+        self.selector = endpoints.EndpointSelector(hosts)
+        self.protocol = protocol
+        self.prefix = prefix
+        self.timeout = timeout
+
+    def url(self, host, path):
+        return "%s://%s:%d%s%s" % (self.protocol, host[0], host[1], self.prefix, path)
+
+    def request(self, path, body, **kw):
+        for host in self.selector.ordered():
+            start = time.time()
+            try:
+                response = self.http.request("POST", self.url(host, path),
+                    body=json.dumps(body), headers={"Content-Type": "application/json"},
+                    retries=False, **kw)
+            except urllib3.exceptions.HTTPError as e:
+                logging.info("etcd endpoint %s:%d failed: %s", host[0], host[1], e)
+                self.selector.failure(host)
+                continue
+            if response.status >= 500:
+                logging.info("etcd endpoint %s:%d failed: %d", host[0], host[1], response.status)
+                self.selector.failure(host)
+                response.release_conn()
+                continue
+            self.selector.success(host, time.time() - start)
+            return response
+        raise Etcd3ConnectionFailed("No more endpoints to try")
+
+    def call(self, path, body):
+        response = self.request(path, body, timeout=self.timeout)
+        if response.status != 200:
+            raise Etcd3Exception("%s%s: %d %s" % (self.prefix, path, response.status, response.data))
+        return json.loads(response.data)
+
+    def txn(self, puts, lease=None):
+        """
+        Put all the (key, value) pairs in one transaction.
+        """
+        ops = []
+        for key, value in puts:
+            put = { "key": _encode(key), "value": _encode(value) }
+            if lease is not None:
+                put["lease"] = lease
+            ops.append({ "requestPut": put })
+        return self.call("/kv/txn", { "success": ops })
+
+    def grant(self, ttl):
+        """
+        Grant a lease and return its (ID, TTL).
+        """
+        response = self.call("/lease/grant", { "TTL": ttl })
+        return (response["ID"], int(response["TTL"]))
+
+    def keepalive(self, lease):
+        """
+        Refresh the lease and return its new TTL (0 if it has expired).
+        """
+        response = self.call("/lease/keepalive", { "ID": lease })
+        return int(response.get("result", {}).get("TTL", 0))
+
+    def watch_created(self, key):
+        """
+        Yield the values of the keys created under the given prefix.
+        """
+        response = self.request("/watch",
+            { "create_request": { "key": _encode(key), "range_end": base64.b64encode(_prefix_end(key)) } },
+            timeout=urllib3.Timeout(connect=self.timeout, read=None), preload_content=False)
+        try:
+            if response.status != 200:
+                raise Etcd3Exception("%s/watch: %d %s" % (self.prefix, response.status, response.read()))
+            buf = ""
+            for chunk in response.stream(1024, decode_content=True):
+                buf += chunk
+                while "\n" in buf:
+                    line, buf = buf.split("\n", 1)
+                    if not line.strip():
+                        continue
+                    message = json.loads(line)
+                    if "error" in message:
+                        raise Etcd3Exception(message["error"])
+                    for event in message.get("result", {}).get("events", []):
+                        kv = event["kv"]
+                        if event.get("type", "PUT") == "PUT" and kv.get("version") == "1":
+                            yield _decode(kv.get("value", ""))
+        finally:
+            response.release_conn()
@@ -17,29 +17,377 @@ import logging
 import contextlib
 import UserDict
 import threading
+import time
+import Queue
+import module
 
 class Client(object):
 
+    # True if the written keys are kept alive by the client itself,
+    # so that they only need to be rewritten when their values change
+    leased = False
+
+    # incremented whenever the keys written so far may have been lost
+    epoch = 0
+
+    # the number of items worth sending in one write_batch() call
+    batch_size = 1
+
+    # True if write_batch() returns before the items are written
+    asynchronous = False
+
+    # True if the values are pulled from the client (see serve())
+    pull = False
+
     def write(self, name, value, ttl=None):
         assert False
 
     def append(self, name, value, ttl=None):
         assert False
 
+    def write_batch(self, items, ttl=None):
+        """
+        Write all the (name, value) pairs rendered in one tick and return
+        those which could not be written.
+        """
+        failed = []
+        for name, value in items:
+            try:
+                self.write(name, value, ttl=ttl)
+            except:
+                logging.error("Error writing %s" % name, exc_info=True)
+                failed.append((name, value))
+        return failed
+
     def close(self):
         pass
 
     def add_handler(self, context, defaults, name, ntemp, vtemp):
         pass
 
+    def serve(self, source):
+        """
+        Serve the values returned by source() - a list of (name, value) -
+        on request; only called on pull clients.
+        """
+        assert False
+
+class AsyncClient(Client):
+
+    """
+    Decouples writing from rendering: write_batch() splits the items into
+    batches and puts them on a bounded queue drained by a pool of writer
+    threads. If the queue stays full for `timeout` seconds, the batch is
+    dropped. Failed items are reported by the next write_batch() call.
+    """
+
+    asynchronous = True
+
+    def __init__(self, client, writers=4, queue_size=100, timeout=None, stats=None):
+        self.client = client
+        self.stats = stats
+        self.queue = Queue.Queue(queue_size)
+        self.timeout = timeout
+        self.failed = []
+        self.lock = threading.Lock()
+        for i in range(writers):
+            WriterThread("writer-%d" % i, self).start()
+
+    @property
+    def leased(self):
+        return self.client.leased
+
+    @property
+    def epoch(self):
+        return self.client.epoch
+
+    def write(self, name, value, ttl=None):
+        self.client.write(name, value, ttl=ttl)
+
+    def append(self, name, value, ttl=None):
+        self.client.append(name, value, ttl=ttl)
+
+    def write_batch(self, items, ttl=None):
+        dropped = []
+        size = self.client.batch_size
+        for pos in range(0, len(items), size):
+            chunk = items[pos:pos+size]
+            try:
+                self.queue.put((chunk, ttl), timeout=self.timeout)
+            except Queue.Full:
+                logging.error("Write queue is full, dropping %d items" % len(chunk))
+                dropped.extend(chunk)
+        with self.lock:
+            failed, self.failed = self.failed, []
+        return failed + dropped
+
+    def drain(self):
+        while True:
+            (items, ttl) = self.queue.get()
+            start = time.time()
+            try:
+                failed = self.client.write_batch(items, ttl=ttl)
+            except:
+                logging.error("Error writing %d items" % len(items), exc_info=True)
+                failed = items
+            if self.stats is not None:
+                self.stats.record(time.time() - start, len(items), len(failed))
+            if failed:
+                with self.lock:
+                    self.failed.extend(failed)
+            self.queue.task_done()
+
+    def close(self):
+        self.client.close()
+
+    def add_handler(self, context, defaults, name, ntemp, vtemp):
+        self.client.add_handler(context, defaults, name, ntemp, vtemp)
+
+class WriteStats(object):
+
+    """
+    Write latency and failure counters accumulated between calls to take().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.batches = 0
+        self.latency = 0.0
+        self.items = 0
+        self.failed = 0
+
+    def record(self, latency, items, failed):
+        with self.lock:
+            self.batches += 1
+            self.latency += latency
+            self.items += items
+            self.failed += failed
+
+    def take(self):
+        """
+        Return the average batch latency and the failed items ratio
+        (or None if nothing has been written) and reset the counters.
+        """
+        with self.lock:
+            if not self.batches:
+                return None
+            result = (self.latency / self.batches, float(self.failed) / self.items if self.items else 0.0)
+            self.reset()
+            return result
+
+class ExporterThread(threading.Thread):
+
+    def __init__(self, client, source):
+        super(ExporterThread, self).__init__(name="exporter")
+        self.daemon = True
+        self.client = client
+        self.source = source
+
+    def run(self):
+        try:
+            self.client.serve(self.source)
+        except:
+            logging.error("Error serving the items", exc_info=True)
+
+class WriterThread(threading.Thread):
+
+    def __init__(self, name, client):
+        super(WriterThread, self).__init__(name=name)
+        self.daemon = True
+        self.client = client
+
+    def run(self):
+        self.client.drain()
+
 class StdoutClient(Client):
 
     def write(self, name, value, ttl=None):
         print "%s = %s" % (name, value)
 
+class FanoutClient(Client):
+
+    """
+    Publishes the same rendered items to several clients: the first one
+    is the primary, whose failures are reported and whose handlers
+    are used, the failures of the rest are only logged by them.
+    """
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.primary = clients[0]
+
+    @property
+    def leased(self):
+        return self.primary.leased
+
+    @property
+    def epoch(self):
+        return self.primary.epoch
+
+    @property
+    def asynchronous(self):
+        return self.primary.asynchronous
+
+    def write(self, name, value, ttl=None):
+        self.write_batch([(name, value)], ttl=ttl)
+
+    def write_batch(self, items, ttl=None):
+        for client in self.clients[1:]:
+            client.write_batch(items, ttl=ttl)
+        return self.primary.write_batch(items, ttl=ttl)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+    def add_handler(self, context, defaults, name, ntemp, vtemp):
+        self.primary.add_handler(context, defaults, name, ntemp, vtemp)
+
+class StatsdClient(Client):
+
+    """
+    Sends the numeric values as StatsD gauges over UDP, the key path
+    turned into the metric name (/a/b/cpu -> a.b.cpu).
+    """
+
+    batch_size = 20
+
+    def __init__(self, host, port):
+        import socket
+        self.address = (host or "localhost", port or 8125)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    @staticmethod
+    def metric(name):
+        import re
+        return re.sub(r"[^A-Za-z0-9_.-]", "_", name.strip("/").replace("/", "."))
+
+    def write(self, name, value, ttl=None):
+        self.write_batch([(name, value)], ttl=ttl)
+
+    def write_batch(self, items, ttl=None):
+        lines = []
+        for name, value in items:
+            try:
+                lines.append("%s:%r|g" % (self.metric(name), float(value)))
+            except ValueError:
+                continue
+        if lines:
+            self.socket.sendto("\n".join(lines), self.address)
+        return []
+
+    def close(self):
+        self.socket.close()
+
+class JsonLinesClient(Client):
+
+    """
+    Appends the items to a file, one JSON object per line:
+    {"time": ..., "key": ..., "value": ...}.
+    """
+
+    batch_size = 100
+
+    def __init__(self, path):
+        self.fp = open(path, "a")
+
+    def write(self, name, value, ttl=None):
+        self.write_batch([(name, value)], ttl=ttl)
+
+    def write_batch(self, items, ttl=None):
+        import json
+        now = time.time()
+        for name, value in items:
+            self.fp.write(json.dumps({ "time": now, "key": name, "value": value }) + "\n")
+        self.fp.flush()
+        return []
+
+    def close(self):
+        self.fp.close()
+
+class PrometheusClient(Client):
+
+    """
+    Serves the items at http://host:port/metrics in the Prometheus text
+    format: numeric values as etcdstat_value{key="..."}, the rest as
+    etcdstat_info{key="...",value="..."} 1. The items returned by the
+    source (rendered on scrape, or those of the last tick when it is an
+    additional sink) are reused by the scrapes within `freshness` seconds.
+    """
+
+    pull = True
+
+    def __init__(self, host, port, freshness):
+        self.address = (host or "", port or 9100)
+        self.freshness = freshness
+        self.lock = threading.Lock()
+        self.metrics = None
+        self.rendered = None
+
+    @staticmethod
+    def escape(s):
+        return s.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+    def format(self, items):
+        values = []
+        infos = []
+        for name, value in items:
+            try:
+                values.append("etcdstat_value{key=\"%s\"} %r" % (self.escape(name), float(value)))
+            except ValueError:
+                infos.append("etcdstat_info{key=\"%s\",value=\"%s\"} 1" % (self.escape(name), self.escape(value)))
+        lines = ["# TYPE etcdstat_value gauge"] + values + ["# TYPE etcdstat_info gauge"] + infos
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def collect(self, source):
+        import scheduler
+        # concurrent scrapes wait for one rendering and share it
+        with self.lock:
+            now = scheduler.monotonic()
+            if self.metrics is None or now - self.rendered > self.freshness:
+                self.metrics = self.format(source())
+                self.rendered = now
+            return self.metrics
+
+    def serve(self, source):
+        import BaseHTTPServer
+        import SocketServer
+
+        client = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                try:
+                    body = client.collect(source)
+                except:
+                    logging.error("Error collecting metrics", exc_info=True)
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(format % args)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        logging.info("Serving metrics at http://%s:%d/metrics" % self.address)
+        Server(self.address, Handler).serve_forever()
+
 class EtcdClient(Client):
 
-    def __init__(self, host, protocol, cert, ca_cert):
+    def __init__(self, host, protocol, cert, ca_cert, pool_size=10, timeout=5):
         """
        Initialize the client.
 
@@ -54,103 +402,421 @@ class EtcdClient(Client):
 
            ca_cert (str): The ca certificate. If pressent it will enable
                           validation.
+
+           pool_size (int): The number of keep-alive connections per host.
+
+           timeout (int): The timeout of a write to a member (sec), after
+                          which the next member is tried.
        """
         import etcd
-        self.client = etcd.Client(host=host, protocol=protocol, cert=cert, ca_cert=ca_cert, allow_reconnect=True)
+        import endpoints
+        import urllib3
+        # the watches go through the client of the whole cluster, while
+        # writes are sent to the preferred member (see EndpointSelector)
+        self.client = etcd.Client(host=host, protocol=protocol, cert=cert, ca_cert=ca_cert, allow_reconnect=True,
+            per_host_pool_size=pool_size)
+        self.clients = { h : etcd.Client(host=h[0], port=h[1], protocol=protocol, cert=cert, ca_cert=ca_cert,
+            per_host_pool_size=pool_size, read_timeout=timeout) for h in host }
+        for client in self.clients.itervalues():
+            # a failed attempt fails over to the next member right away
+            # instead of being retried against the same one
+            client.http = urllib3.PoolManager(num_pools=10, retries=False, **client.http.connection_pool_kw)
+        self.selector = endpoints.EndpointSelector(host)
 
-    def write(self, name, value, ttl=None):
-        self.client.write(name, value, ttl=ttl)
+    def write(self, name, value, ttl=None, **kw):
+        import etcd
+        for host in self.selector.ordered():
+            start = time.time()
+            try:
+                self.clients[host].write(name, value, ttl=ttl, **kw)
+            except (etcd.EtcdKeyError, etcd.EtcdValueError):
+                # the request itself is wrong, another member won't take it either
+                raise
+            except etcd.EtcdException:
+                # not reachable, timed out or failing (5xx, e.g. no leader)
+                logging.info("etcd endpoint %s:%d failed" % host, exc_info=True)
+                self.selector.failure(host)
+                continue
+            self.selector.success(host, time.time() - start)
+            return
+        raise etcd.EtcdConnectionFailed("No more endpoints to try")
 
     def append(self, name, value, ttl=None):
-        self.client.write(name, value, append=True, ttl=ttl)
+        self.write(name, value, append=True, ttl=ttl)
 
     def close(self):
         pass
 
+    def watch_created(self, key):
+        for event in self.client.eternal_watch(key=key,recursive=True):
+            if event.action == "create":
+                yield event.value
+
     def add_handler(self, context, defaults, name, ntemp, vtemp):
-        EtcdHandlerThread(name, ntemp, vtemp, self.client, defaults, context).start()
+        EtcdHandlerThread(name, ntemp, vtemp, self.watch_created, defaults, context).start()
+
+class Etcd3Client(Client):
+
+    def __init__(self, host, protocol, cert, ca_cert, max_txn_ops=128, lease_ttl=None, pool_size=10):
+        """
+       Initialize the client of the etcd v3 API (through its JSON gateway).
+
+       Args:
+           host (mixed):
+                          a tuple ((host, port), (host, port), ...)
+
+           protocol (str):  Protocol used to connect to etcd.
+
+           cert (mixed):   If a string, the whole ssl client certificate;
+                           if a tuple, the cert and key file names.
+
+           ca_cert (str): The ca certificate. If pressent it will enable
+                          validation.
+
+           max_txn_ops (int): Maximum number of operations in one transaction
+                          (the --max-txn-ops setting of the etcd server).
+
+           lease_ttl (int): If set, all keys are attached to one lease with
+                          this TTL, which is kept alive in the background,
+                          instead of being written with their own TTL.
+
+           pool_size (int): The number of keep-alive connections per host.
+       """
+        import etcd3
+        self.client = etcd3.Etcd3(host, protocol, cert, ca_cert, pool_size=pool_size)
+        self.max_txn_ops = max_txn_ops
+        self.lease_ttl = lease_ttl
+        self.lease = None
+        self.lock = threading.Lock()
+        if lease_ttl:
+            self.leased = True
+            EtcdLeaseThread(self).start()
+
+    @property
+    def batch_size(self):
+        return self.max_txn_ops
+
+    def get_lease(self, ttl):
+        if not self.leased:
+            return self.client.grant(ttl)[0] if ttl else None
+        with self.lock:
+            if self.lease is None:
+                self.lease, self.lease_ttl = self.client.grant(self.lease_ttl)
+                logging.info("Granted lease %s (ttl=%d)" % (self.lease, self.lease_ttl))
+            return self.lease
+
+    def keepalive(self):
+        with self.lock:
+            lease = self.lease
+        if lease is None:
+            return
+        if self.client.keepalive(lease) <= 0:
+            logging.warning("Lease %s has expired" % lease)
+            with self.lock:
+                if self.lease == lease:
+                    self.lease = None
+                    self.epoch += 1
+
+    def write(self, name, value, ttl=None):
+        self.client.txn([(name, value)], lease=self.get_lease(ttl))
+
+    def write_batch(self, items, ttl=None):
+        """
+        Write all the items in as few transactions as the server allows.
+        If a transaction fails, all its keys are reported as failed.
+        """
+        import etcd3
+        try:
+            lease = self.get_lease(ttl)
+        except:
+            for name, value in items:
+                logging.error("Error writing %s" % name, exc_info=True)
+            return list(items)
+        failed = []
+        pos = 0
+        while pos < len(items):
+            chunk = items[pos:pos+self.max_txn_ops]
+            try:
+                self.client.txn(chunk, lease=lease)
+            except Exception as e:
+                if isinstance(e, etcd3.Etcd3Exception) and "too many operations" in str(e) and len(chunk) > 1:
+                    # the server limit is lower than ours: retry the chunk in halves
+                    self.max_txn_ops = len(chunk) // 2
+                    logging.warning("Transaction too large, lowering max_txn_ops to %d" % self.max_txn_ops)
+                    continue
+                for name, value in chunk:
+                    logging.error("Error writing %s" % name, exc_info=True)
+                failed.extend(chunk)
+            pos += len(chunk)
+        return failed
+
+    def add_handler(self, context, defaults, name, ntemp, vtemp):
+        EtcdHandlerThread(name, ntemp, vtemp, self.watch_created, defaults, context).start()
+
+    def watch_created(self, key):
+        while True:
+            try:
+                for value in self.client.watch_created(key):
+                    yield value
+            except:
+                logging.error("Error watching %s" % key, exc_info=True)
+                time.sleep(1)
+
+class EtcdLeaseThread(threading.Thread):
+
+    def __init__(self, client):
+        super(EtcdLeaseThread, self).__init__(name="lease")
+        self.daemon = True
+        self.client = client
+
+    def run(self):
+        while True:
+            time.sleep(max(self.client.lease_ttl / 3.0, 0.5))
+            try:
+                self.client.keepalive()
+            except:
+                logging.error("Error refreshing lease", exc_info=True)
 
 class EtcdHandlerThread(threading.Thread):
 
-    def __init__(self, name, ntemp, vtemp, client, defaults, context):
+    def __init__(self, name, ntemp, vtemp, watch, defaults, context):
         super(EtcdHandlerThread, self).__init__(name=name)
         self.daemon = True
         self.ntemp = ntemp
         self.vtemp = vtemp
-        self.client = client
+        self.watch = watch
         self.defaults = defaults
         self.context = context
 
     def run(self):
-        defaults = self.defaults.render(self.context)
-        ctx = dict(self.context)
+        keys = self.defaults.variables | self.ntemp.variables | self.vtemp.variables
+        defaults = self.defaults.render(self.context.evaluate(self.defaults.variables))
+        ctx = self.context.evaluate(keys)
         ctx.update(defaults)
         key = self.ntemp.render(ctx)
-        for event in self.client.eternal_watch(key=key,recursive=True):
-            if event.action == "create":
-                ctx = dict(self.context)
-                ctx.update(defaults)
-                ctx["event"] = event.value
-                try:
-                    self.vtemp.render(ctx)
-                except:
-                    logging.error("Error processing action on %s" % key, exc_info=True)
+        for value in self.watch(key):
+            ctx = self.context.evaluate(keys)
+            ctx.update(defaults)
+            ctx["event"] = value
+            try:
+                self.vtemp.render(ctx)
+            except:
+                logging.error("Error processing action on %s" % key, exc_info=True)
 
 
 class Context(UserDict.DictMixin):
 
+    """
+    The variables provided by the modules. The modules are indexed by
+    their keys when they are added, so a key can be provided by one
+    module only.
+    """
+
     def __init__(self):
         self.modules = []
+        self.index = {}
+        self.snapshot = module.Snapshot()
 
     def __getitem__(self, key):
-        for module in self.modules:
-            if module.provides(key):
-                return module.get(key)
-        raise KeyError(key)
+        return self.index[key].get(key)
 
     def keys(self):
-        return [key for module in self.modules for key in module.keys()]
+        return self.index.keys()
+
+    def provides(self, key):
+        return key in self.index
+
+    def is_probe(self, key):
+        return key in self.index and key in self.index[key].probes
+
+    def evaluate(self, keys):
+        """
+        Return a dict with the values of only those of the given keys
+        that are provided by some module; the rest (template locals,
+        defaults, jinja2 globals) are left for the caller to fill in.
+        """
+        index = self.index
+        return { key : index[key].get(key) for key in keys if key in index }
 
     def add_module(self, module):
-        self.modules.append(module)   
+        keys = module.keys()
+        for key in keys:
+            if key in self.index:
+                raise ValueError("Key %s of %s is already provided by %s" % (key,
+                    type(module).__name__, type(self.index[key]).__name__))
+        module.snapshot = self.snapshot
+        self.modules.append(module)
+        for key in keys:
+            self.index[key] = module
 
 class Template(object):
 
-    def __init__(self, repr, template):
+    def __init__(self, repr, template, variables=frozenset(), spec=None, fast=None, calls=frozenset()):
         self.repr = repr
         self.template = template
+        self.variables = variables
+        self.spec = spec
+        self.fast = fast
+        self.calls = calls
 
     def __repr__(self):
         return self.repr 
 
     def render(self, context):
+        if self.fast is not None:
+            return self.fast(context)
         return self.template.render(context)
 
+def compile_template(env, source, cache=None):
+    """
+    Compile the template source and collect the names of the variables
+    it references so that only those are evaluated at render time, and
+    the calls it makes which can be sampled ahead (see sampling.py).
+    Trivial templates are also compiled into direct lookups and calls
+    (see templates.py). With a cache (templates.AnalysisCache), the
+    environment loads the templates by their sources through its
+    bytecode cache and the AST is only parsed for the new sources.
+    """
+    import templates
+    analysis = cache.get(source) if cache is not None else None
+    if analysis is None:
+        from jinja2 import meta
+        ast = env.parse(source)
+        analysis = (frozenset(meta.find_undeclared_variables(ast)), templates.analyze(ast), templates.calls(ast))
+        if cache is not None:
+            cache.put(source, analysis)
+        template = env.from_string(ast) if cache is None else env.get_template(source)
+    else:
+        template = env.get_template(source)
+    (variables, spec, calls) = analysis
+    return Template(source, template, variables, spec, templates.build(spec, env) if spec is not None else None, calls)
+
 class EtcdStat(object):
 
-    def __init__(self, endpoints, cert, ca_cert, interval, items, handlers, defaults):
-        from urlparse import urlparse
+    def __init__(self, endpoints, cert, ca_cert, interval, items, handlers, defaults, api="2", deadbands=(), refresh=None,
+            writers=0, spool=None, spool_size=1024*1024, replay_rate=100, intervals=(), pack=False, max_backoff=8.0,
+            freshness=None, sinks=(), single_pass=False, cache_dir=None, samplers=0, deadline=None,
+            on_change=None):
         from jinja2 import Environment
-        env = Environment()
-        self.items = { n : (Template(n, env.from_string(n)), Template(v, env.from_string(v))) for (n,v) in items }
-        self.handlers = { n : (Template(n, env.from_string(n)), Template(v, env.from_string(v))) for (n,v) in handlers }
+        started = time.time()
+        if cache_dir:
+            from jinja2 import FileSystemBytecodeCache, FunctionLoader
+            import os
+            import templates
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # the templates are loaded by their sources as the names
+            env = Environment(loader=FunctionLoader(lambda source: source),
+                bytecode_cache=FileSystemBytecodeCache(cache_dir), cache_size=0)
+            cache = templates.AnalysisCache(cache_dir,
+                [s for (n, v) in list(items) + list(handlers) for s in (n, v)] + [v for (n, v) in defaults])
+        else:
+            env = Environment()
+            cache = None
+        self.items = { n : (compile_template(env, n, cache), compile_template(env, v, cache)) for (n,v) in items }
+        self.handlers = { n : (compile_template(env, n, cache), compile_template(env, v, cache)) for (n,v) in handlers }
         self.interval = interval
 
-        parsed_endpoints = map(urlparse, endpoints.split(','))
+        self.stats = WriteStats()
+        # the number of items sent since the last adapt_interval()
+        self.sent = 0
+        self.client = self.create_client(endpoints, cert, ca_cert, api, max(writers, 1), freshness)
+        if sinks and self.client.pull:
+            raise ValueError("Additional sinks can't be used with a pull endpoint")
+        # the pull sinks serve the values rendered by the ticks (see run())
+        self.exporters = []
+        pushed = []
+        for sink in sinks:
+            client = self.create_client(sink, cert, ca_cert, api, 1, freshness)
+            if client.pull:
+                self.exporters.append(client)
+            else:
+                pushed.append(client)
+        self.freshness = freshness if freshness is not None else self.interval
+        self.render_lock = threading.Lock()
+        self.latest = {}
+        self.rendered_at = None
+        if pushed:
+            # every sink gets its own queue, which never blocks the tick
+            clients = [AsyncClient(self.client, writers=max(writers, 1), timeout=0, stats=self.stats)]
+            for client in pushed:
+                clients.append(AsyncClient(client, writers=1, timeout=0))
+            self.client = FanoutClient(clients)
+        elif writers > 0:
+            self.client = AsyncClient(self.client, writers=writers, timeout=self.interval, stats=self.stats)
 
-        if len(parsed_endpoints) <= 0:
-            raise ValueError("Endpoint parameter is empty or missing")
+        self.defaults = TemplateDict({ n : compile_template(env, v, cache) for (n,v) in defaults })
 
-        scheme = parsed_endpoints[0].scheme
+        count = 2 * (len(self.items) + len(self.handlers)) + len(self.defaults.items)
+        if cache is not None:
+            try:
+                cache.save()
+            except:
+                logging.warning("Error saving the template cache", exc_info=True)
+            logging.info("Compiled %d templates (%d cached) in %.3f sec" % (count, cache.hits, time.time() - started))
+        else:
+            logging.info("Compiled %d templates in %.3f sec" % (count, time.time() - started))
 
-        if scheme == "stdout":
-            self.client = StdoutClient()
+        # the names which depend on the defaults only are rendered once
+        # and then only when the rendered defaults change
+        self.static_names = frozenset(p for (p, (name, value)) in self.items.iteritems()
+            if name.variables <= frozenset(self.defaults.items))
+        self.names = {}
+        self.names_defaults = None
+
+        if single_pass:
+            import templates
+            self.program = templates.compile_program(
+                [(p, name, value, p in self.static_names) for (p, (name, value)) in self.items.iteritems()], env)
         else:
-            self.client = EtcdClient(
-                tuple(map(lambda e: (e.hostname, e.port if e.port else 80 if e.scheme == "http" else 443), parsed_endpoints)),
-                scheme, cert, ca_cert)
+            self.program = None
 
-        self.defaults = TemplateDict({ n : Template(v, env.from_string(v)) for (n,v) in defaults })
+        if samplers > 0:
+            import sampling
+            self.sampler = sampling.Sampler(env, workers=samplers,
+                deadline=deadline if deadline is not None else self.interval)
+        else:
+            self.sampler = None
+
+        self.deadbands = {}
+        for (n, v) in deadbands:
+            if n not in self.items:
+                logging.warning("Deadband for unknown item %s" % n)
+            self.deadbands[n] = float(v)
+
+        import scheduler
+        if self.interval <= 0:
+            raise ValueError("Invalid interval: %s" % self.interval)
+        self.intervals = { n : self.interval for n in self.items }
+        for (n, v) in intervals:
+            if n not in self.items:
+                logging.warning("Interval for unknown item %s" % n)
+                continue
+            if float(v) <= 0:
+                raise ValueError("Invalid interval for %s: %s" % (n, v))
+            self.intervals[n] = float(v)
+        self.scheduler = scheduler.Scheduler()
+        for n in self.items:
+            self.scheduler.add(n, self.intervals[n])
+        self.backoff = scheduler.Backoff(max_factor=max_backoff)
+
+        # leased keys don't expire, so they needn't be refreshed by default;
+        # otherwise keys are written with a TTL covering the refresh period
+        if refresh is None:
+            refresh = 0 if self.client.leased else 1
+        self.refresh = refresh
+        self.update_ttls()
+        self.filter = ChangeFilter(refresh)
+        self.epoch = self.client.epoch
+        self.packer = Packer() if pack else None
+
+        if spool:
+            import spool as _spool
+            self.spool = _spool.Spool(spool, max_size=spool_size)
+        else:
+            self.spool = None
+        self.written_ttls = {}
+        self.replay_rate = replay_rate
 
         self.context = Context()
 
@@ -160,28 +826,126 @@ class EtcdStat(object):
         import host
         import systemd
         import os_support
+        import agent
+        self.context.add_module(agent.Agent(self))
         self.context.add_module(cpu.Cpu())
         self.context.add_module(memory.Memory())
         self.context.add_module(disk.Disk())                
         self.context.add_module(host.Host())
-        self.context.add_module(systemd.Systemd())
+        units = systemd.Systemd()
+        self.context.add_module(units)
         self.context.add_module(os_support.OS())
 
+        # the items to publish when the state of a unit changes
+        self.on_change = on_change
+        self.unit_items = {}
+        self.events = Queue.Queue()
+        self.pending = {}
+        self.published_at = {}
+        if on_change is not None:
+            import templates
+            for (p, (name, value)) in self.items.iteritems():
+                for spec in name.calls | value.calls:
+                    if templates.root(spec) == "unit" and templates.arguments(spec):
+                        self.unit_items.setdefault(templates.arguments(spec)[0], set()).add(p)
+            if not systemd.signals:
+                logging.warning("The D-Bus signals aren't received, the unit state changes won't be published immediately")
+            units.add_listener(self.unit_changed)
+
         for n in self.handlers:
             self.client.add_handler(self.context, self.defaults, n, *(self.handlers[n]))
 
-    def update_etcd(self):
-        import jinja2
+    def create_client(self, endpoints, cert, ca_cert, api, pool_size, freshness):
+        from urlparse import urlparse
+
+        parsed_endpoints = map(urlparse, endpoints.split(','))
+
+        if len(parsed_endpoints) <= 0:
+            raise ValueError("Endpoint parameter is empty or missing")
+
+        scheme = parsed_endpoints[0].scheme
+
+        if scheme == "stdout":
+            return StdoutClient()
+        elif scheme == "prometheus":
+            return PrometheusClient(parsed_endpoints[0].hostname, parsed_endpoints[0].port,
+                freshness if freshness is not None else self.interval)
+        elif scheme == "statsd":
+            return StatsdClient(parsed_endpoints[0].hostname, parsed_endpoints[0].port)
+        elif scheme == "file":
+            return JsonLinesClient(parsed_endpoints[0].path)
+        elif api == "3":
+            return Etcd3Client(
+                tuple(map(lambda e: (e.hostname, e.port if e.port else 80 if e.scheme == "http" else 443), parsed_endpoints)),
+                scheme, cert, ca_cert, lease_ttl=int(self.interval*2), pool_size=pool_size)
+        else:
+            return EtcdClient(
+                tuple(map(lambda e: (e.hostname, e.port if e.port else 80 if e.scheme == "http" else 443), parsed_endpoints)),
+                scheme, cert, ca_cert, pool_size=pool_size)
 
-        defaults = self.defaults.render(self.context)
+    def ttl_for(self, interval):
+        if self.client.leased or not self.refresh:
+            return None
+        # the keys must outlive the refresh period at the stretched interval
+        return int(interval*self.scheduler.factor*(self.refresh + 1))
+
+    def update_ttls(self):
+        self.ttl = self.ttl_for(self.interval)
+        self.ttls = { n : self.ttl_for(self.intervals[n]) for n in self.items }
+
+    def render(self, items=None):
+        """
+        Render the given items (all by default) and return the list
+        of (item, name, value).
+        """
+        if items is None:
+            items = self.items.keys()
+
+        snapshot = self.context.snapshot
+        snapshot.clear()
+        # only the context keys referenced by the items are evaluated
+        keys = set(self.defaults.variables)
+        calls = set()
+        for p in items:
+            (name, value) = self.items[p]
+            keys |= name.variables | value.variables
+            calls |= name.calls | value.calls
+        if self.sampler is not None:
+            (ctx, missed) = self.sampler.evaluate(self.context, keys, calls)
+            if missed & self.defaults.variables:
+                logging.warning("Skipping the tick: the defaults can't be rendered")
+                return []
+            items = [p for p in items if not missed & self.dependencies(p)]
+        else:
+            ctx = self.context.evaluate(keys)
+        defaults = self.defaults.render(ctx)
         #print "defaults =", defaults 
-        ctx = dict(self.context)
         ctx.update(defaults)
 
-        for p in self.items:
+        if defaults != self.names_defaults:
+            if self.names_defaults is not None:
+                # the keys may have been renamed: forget the old ones
+                self.filter.clear()
+                if self.packer is not None:
+                    self.packer.clear()
+            self.names = {}
+            self.names_defaults = defaults
+
+        if self.program is not None:
+            result = self.program(ctx, set(items), self.names, self.render_failed)
+            logging.debug("Snapshot cache: %d hits, %d misses" % (snapshot.hits, snapshot.misses))
+            return result
+
+        result = []
+        for p in items:
             (name, value) = self.items[p]
             try:
-                _name = name.render(ctx)
+                if p in self.names:
+                    _name = self.names[p]
+                else:
+                    _name = name.render(ctx)
+                    if p in self.static_names:
+                        self.names[p] = _name
             except:
                 logging.error("Error rendering %s" % name, exc_info=True)
                 continue
@@ -190,29 +954,333 @@ class EtcdStat(object):
             except:
                 logging.error("Error rendering %s" % value, exc_info=True)
                 continue
-            try:
-                self.client.write(_name, _value, ttl=int(self.interval*2))
-            except:
-                logging.error("Error writing %s" % _name, exc_info=True)
-                continue
+            result.append((p, _name, _value))
+
+        logging.debug("Snapshot cache: %d hits, %d misses" % (snapshot.hits, snapshot.misses))
+        return result
+
+    def remember(self, rendered):
+        import scheduler
+        for (p, name, value) in rendered:
+            self.latest[p] = (name, value)
+        self.rendered_at = scheduler.monotonic()
+
+    def latest_items(self):
+        """
+        Return the (name, value) pairs rendered by the last tick for the
+        pull sinks, or render all the items again if the last tick is
+        older than `freshness` seconds.
+        """
+        import scheduler
+        with self.render_lock:
+            if self.rendered_at is None or scheduler.monotonic() - self.rendered_at > self.freshness:
+                self.remember(self.render())
+            return sorted(self.latest.itervalues())
+
+    def dependencies(self, item):
+        (name, value) = self.items[item]
+        return name.variables | value.variables | name.calls | value.calls
+
+    def render_failed(self, template):
+        logging.error("Error rendering %s" % template, exc_info=True)
+
+    def update_etcd(self, items=None):
+        if self.epoch != self.client.epoch:
+            # the keys written so far may have been lost (e.g. with their lease)
+            self.epoch = self.client.epoch
+            self.filter.clear()
+        with self.render_lock:
+            rendered = self.render(items)
+            if self.exporters:
+                self.remember(rendered)
+        if self.packer is not None:
+            healthy = self.update_packed(rendered)
+        else:
+            batches = {}
+            for (p, name, value) in rendered:
+                if self.filter.changed(name, value, self.deadbands.get(p)):
+                    batches.setdefault(self.ttls[p], []).append((name, value))
+            written = []
+            failed = []
+            for ttl, batch in batches.iteritems():
+                batch_failed = self.write_batch(batch, ttl=ttl)
+                self.filter.update(batch, batch_failed)
+                written.extend(batch)
+                failed.extend(batch_failed)
+            if self.spool is not None:
+                self.update_spool(written, failed)
+            healthy = not failed
+        if self.spool is not None and healthy and len(self.spool):
+            self.replay_spool()
+
+    def write_batch(self, items, ttl=None):
+        start = time.time()
+        self.sent += len(items)
+        if self.spool is not None:
+            # the spooled values are replayed with the same TTLs
+            for name, value in items:
+                self.written_ttls[name] = ttl
+        failed = self.client.write_batch(items, ttl=ttl)
+        if not self.client.asynchronous:
+            self.stats.record(time.time() - start, len(items), len(failed))
+        return failed
+
+    def adapt_interval(self):
+        """
+        Stretch the intervals while etcd is slow or failing (see Backoff).
+        A tick which has nothing to write (e.g. all the values are
+        unchanged) counts as a healthy one.
+        """
+        stats = self.stats.take()
+        sent, self.sent = self.sent, 0
+        if stats is None:
+            if sent:
+                # the writes are still queued (see AsyncClient)
+                return
+            stats = (0.0, 0.0)
+        factor = self.backoff.update(*stats)
+        if factor != self.scheduler.factor:
+            logging.warning("Write latency %.3f sec, %d%% failed: effective interval is now %g sec" %
+                (stats[0], stats[1] * 100, self.interval * factor))
+            self.scheduler.factor = factor
+            self.update_ttls()
+
+    @property
+    def effective_interval(self):
+        return self.interval * self.scheduler.factor
+
+    def update_packed(self, rendered):
+        """
+        Rewrite the packed document if any of the items has changed and
+        return False if it couldn't be written.
+        """
+        self.packer.update((name, value) for (p, name, value) in rendered)
+        changed = [(name, value) for (p, name, value) in rendered
+            if self.filter.changed(name, value, self.deadbands.get(p))]
+        if not changed:
+            return True
+        ttls = [ttl for ttl in self.ttls.itervalues() if ttl is not None]
+        batch = [self.packer.document()]
+        failed = self.write_batch(batch, ttl=max(ttls) if ttls else None)
+        self.filter.update(changed, changed if failed else ())
+        if self.spool is not None:
+            self.update_spool(batch, failed)
+        return not failed
+
+    def update_spool(self, items, failed):
+        """
+        Spool the values which couldn't be written and drop those
+        superseded by the values just written.
+        """
+        if self.client.asynchronous:
+            # the failures are those of the earlier ticks (see AsyncClient):
+            # the values of the same keys just queued supersede them
+            names = set(name for name, value in items)
+            failed = [(name, value) for name, value in failed if name not in names]
+        if failed:
+            logging.warning("Spooling %d values" % len(failed))
+            self.spool.put(failed)
+        failed_names = set(name for name, value in failed)
+        self.spool.discard(name for name, value in items if name not in failed_names)
+
+    def replay_spool(self):
+        """
+        Replay up to `replay_rate` spooled values, each with the TTL its
+        key was last written with.
+        """
+        replay = self.spool.take(self.replay_rate)
+        logging.info("Replaying %d of %d spooled values" % (len(replay), len(self.spool)))
+        batches = {}
+        for name, value in replay:
+            batches.setdefault(self.written_ttls.get(name, self.ttl), []).append((name, value))
+        failed = []
+        for ttl, batch in batches.iteritems():
+            failed.extend(self.write_batch(batch, ttl=ttl))
+        self.update_spool(replay, failed)
+
+    def phase(self):
+        """
+        Return this host's offset of the ticks within the default interval,
+        derived from the rendered defaults (the instance key).
+        """
+        import scheduler
+        import socket
+        try:
+            defaults = self.defaults.render(self.context.evaluate(self.defaults.variables))
+            key = repr(sorted(defaults.items())) if defaults else socket.gethostname()
+        except:
+            logging.error("Error rendering defaults", exc_info=True)
+            key = socket.gethostname()
+        return scheduler.phase(key, self.interval)
 
     def run(self):
         import time        
+        import scheduler
+        if self.client.pull:
+            self.client.serve(lambda: [(name, value) for (p, name, value) in self.render()])
+            return
+        for exporter in self.exporters:
+            ExporterThread(exporter, self.latest_items).start()
+        # start on this host's phase of the wall clock grid, so that
+        # the fleet spreads its writes evenly across the interval
+        offset = self.phase()
+        delay = (offset - time.time()) % self.interval
+        logging.info("Starting in %.3f sec (phase %.3f sec)" % (delay, offset))
+        self.scheduler.start(scheduler.monotonic() + delay)
         while True:
+            deadline = self.scheduler.next_deadline()
+            if deadline is None:
+                # no items to publish (e.g. handlers only)
+                deadline = scheduler.monotonic() + self.interval
+            timeout = max(deadline - scheduler.monotonic(), 0)
+            if self.on_change is not None:
+                self.wait_for_changes(timeout)
+            else:
+                time.sleep(timeout)
+            due = self.scheduler.pop_due(scheduler.monotonic())
+            if due:
+                try:
+                    self.update_etcd(due)
+                except:
+                    logging.error("Error", exc_info=True)
+                    pass
+                self.adapt_interval()
+
+    def unit_changed(self, name):
+        if name in self.unit_items:
+            self.events.put(name)
+
+    def wait_for_changes(self, timeout):
+        """
+        Wait for `timeout` seconds, meanwhile publishing the items which
+        depend on the units whose state changes, at most once per
+        `on_change` seconds per unit.
+        """
+        import scheduler
+        end = scheduler.monotonic() + timeout
+        while True:
+            now = scheduler.monotonic()
+            for (name, ready) in self.pending.items():
+                if ready <= now:
+                    del self.pending[name]
+                    self.publish_unit(name)
+            if now >= end:
+                return
             try:
-                self.update_etcd()
-            except:
-                logging.error("Error", exc_info=True)
-                pass
-            time.sleep(self.interval)
+                name = self.events.get(timeout=min([end] + self.pending.values()) - now)
+            except Queue.Empty:
+                continue
+            if name not in self.pending:
+                last = self.published_at.get(name)
+                self.pending[name] = now if last is None else last + self.on_change
+
+    def publish_unit(self, name):
+        import scheduler
+        self.published_at[name] = scheduler.monotonic()
+        items = self.unit_items[name]
+        logging.info("Unit %s has changed its state, publishing %d items" % (name, len(items)))
+        try:
+            self.update_etcd(items)
+        except:
+            logging.error("Error", exc_info=True)
 
     def close(self):
         self.client.close()
+        for exporter in self.exporters:
+            exporter.close()
+        if self.spool is not None:
+            self.spool.close()
+        if self.sampler is not None:
+            self.sampler.close()
+
+class ChangeFilter(object):
+
+    """
+    Remembers the last value published for each key and lets through only
+    the values that have changed (for numeric values, by more than the
+    deadband of the key). An unchanged key is still republished every
+    `refresh` ticks, i.e. after `refresh`-1 skipped ones; refresh=0 never
+    forces it.
+    """
+
+    def __init__(self, refresh=1):
+        self.refresh = refresh
+        self.published = {}
+
+    def clear(self):
+        self.published = {}
+
+    def changed(self, name, value, deadband=None):
+        try:
+            (last, age) = self.published[name]
+        except KeyError:
+            return True
+        if self.refresh and age + 1 >= self.refresh:
+            return True
+        if value == last:
+            unchanged = True
+        elif deadband:
+            try:
+                unchanged = abs(float(value) - float(last)) <= deadband
+            except ValueError:
+                unchanged = False
+        else:
+            unchanged = False
+        if unchanged:
+            self.published[name] = (last, age + 1)
+            return False
+        return True
+
+    def update(self, written, failed=()):
+        for name, value in written:
+            self.published[name] = (value, 0)
+        for name, value in failed:
+            self.published.pop(name, None)
+
+class Packer(object):
+
+    """
+    Packs the latest values of all items into one JSON document, written
+    under the longest common path of their keys. Every key maps to a nested
+    object by the rest of its path, e.g. /a/b/cpu and /a/b/v2/tag are
+    packed into {"cpu": ..., "v2": {"tag": ...}} under /a/b.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def clear(self):
+        self.values = {}
+
+    def update(self, items):
+        for name, value in items:
+            self.values[name] = value
+
+    def document(self):
+        import json
+        import os.path
+        paths = { name : [seg for seg in name.split("/") if seg] for name in self.values }
+        common = os.path.commonprefix(paths.values())
+        if any(len(segs) <= len(common) for segs in paths.itervalues()):
+            common = common[:-1]
+        doc = {}
+        for name, segs in sorted(paths.iteritems()):
+            node = doc
+            for seg in segs[len(common):-1]:
+                node = node.setdefault(seg, {})
+                if not isinstance(node, dict):
+                    break
+            if not isinstance(node, dict) or isinstance(node.get(segs[-1]), dict):
+                logging.error("Can't pack %s: conflicts with another key" % name)
+                continue
+            node[segs[-1]] = self.values[name]
+        return ("/" + "/".join(common), json.dumps(doc, sort_keys=True))
 
 class TemplateDict(object):
 
     def __init__(self, src):
         self.items = src
+        self.variables = frozenset(var for value in src.itervalues() for var in value.variables)
 
     def render(self, context):
         return { name: value.render(context) for (name, value) in self.items.iteritems() }
@@ -226,14 +1294,32 @@ def main():
     dbus.mainloop.glib.threads_init()
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("url", metavar="URL", help="Etcd URL", default="http://localhost:2379", nargs='?')
+    parser.add_argument("url", metavar="URL", help="Etcd URL (or prometheus://[HOST]:PORT to serve the items for scraping)", default="http://localhost:2379", nargs='?')
+    parser.add_argument("-s", "--sink", metavar="URL", help="Additional sink (etcd URL, stdout://, statsd://HOST:PORT, file:///PATH for JSON lines or prometheus://[HOST]:PORT to serve the last polled items for scraping); may be repeated", action="append", default=[])
     parser.add_argument("-c", "--config", metavar="CONFIG", help="Configuration file", default="/etc/etcdstat.cfg")
-    parser.add_argument("-i", "--interval", metavar="INTERVAL", help="Poll interval (sec)", type=float, default="10")
+    parser.add_argument("-i", "--interval", metavar="INTERVAL", help="Default poll interval (sec), see also the [Intervals] section", type=float, default="10")
     parser.add_argument("-l", "--loglevel", metavar="LOGLEVEL", help="Log level", default="ERROR")
+    parser.add_argument("-r", "--refresh", metavar="TICKS", help="Republish unchanged values every TICKS polls (0 - never; default: 1, or 0 with ETCDCTL_API=3)", type=int, default=None)
+    parser.add_argument("-w", "--writers", metavar="WRITERS", help="Number of concurrent writers (0 - write synchronously)", type=int, default=0)
+    parser.add_argument("-b", "--max-backoff", metavar="FACTOR", help="Maximum factor the interval is stretched by while etcd is slow or failing (1 - never)", type=float, default=8)
+    parser.add_argument("-p", "--pack", help="Publish all the items as one JSON document", action="store_true")
+    parser.add_argument("--cache-dir", metavar="DIR", help="Cache the compiled templates in DIR", default=None)
+    parser.add_argument("--single-pass", help="Compile all the items into one program rendering them in a single pass", action="store_true")
+    parser.add_argument("--samplers", metavar="THREADS", help="Sample concurrently in THREADS threads (0 - sample in the polling thread)", type=int, default=0)
+    parser.add_argument("--deadline", metavar="SEC", help="How long the concurrent samplers may take per poll (default: the interval)", type=float, default=None)
+    parser.add_argument("--on-change", metavar="SEC", help="Publish the items depending on a systemd unit as soon as its state changes, at most once per SEC per unit", type=float, default=None)
+    parser.add_argument("--freshness", metavar="SEC", help="How long the rendered items are served to the scrapes (default: the interval)", type=float, default=None)
+    parser.add_argument("--spool", metavar="FILE", help="Spool the values which couldn't be written to FILE and replay them later", default=None)
+    parser.add_argument("--spool-size", metavar="BYTES", help="Maximum spool size (bytes)", type=int, default=1024*1024)
+    parser.add_argument("--replay-rate", metavar="COUNT", help="Maximum number of spooled values replayed per poll", type=int, default=100)
 
     args = parser.parse_args()
     
     logging.basicConfig(level=args.loglevel)
+
+    # deliver the D-Bus signals
+    import systemd
+    systemd.start_main_loop()
     
     config_dir = os.path.dirname(args.config)
     config = complexini.ComplexIniFile(root_dir=config_dir if config_dir else None)
@@ -255,10 +1341,21 @@ def main():
         for name, value in config.items(sect):
             handlers.append((name, value))
 
+    deadbands = []
+    for sect in ["Deadbands"]:
+        for name, value in config.items(sect):
+            deadbands.append((name, value))
+
+    intervals = []
+    for sect in ["Intervals"]:
+        for name, value in config.items(sect):
+            intervals.append((name, value))
+
     endpoints = os.environ.get("ETCDCTL_ENDPOINT", args.url)
     cert_file = os.environ.get("ETCDCTL_CERT_FILE")
     key_file = os.environ.get("ETCDCTL_KEY_FILE")
     ca_cert = os.environ.get("ETCDCTL_CACERT")
+    api = os.environ.get("ETCDCTL_API", "2")
 
     logging.debug(os.environ)
 
@@ -267,12 +1364,18 @@ def main():
     else:
         cert = None
 
-    with create_etcdstat(endpoints, cert, ca_cert, args.interval, items, handlers, defaults) as etcdstat:
+    with create_etcdstat(endpoints, cert, ca_cert, args.interval, items, handlers, defaults, api=api,
+            deadbands=deadbands, refresh=args.refresh, writers=args.writers,
+            spool=args.spool, spool_size=args.spool_size, replay_rate=args.replay_rate,
+            intervals=intervals, pack=args.pack, max_backoff=args.max_backoff,
+            freshness=args.freshness, sinks=args.sink, single_pass=args.single_pass,
+            cache_dir=args.cache_dir, samplers=args.samplers, deadline=args.deadline,
+            on_change=args.on_change) as etcdstat:
         etcdstat.run()
 
 @contextlib.contextmanager
-def create_etcdstat(endpoints, cert, ca_cert, interval, items, handlers, defaults):
-    etcdstat = EtcdStat(endpoints, cert, ca_cert, interval, items, handlers, defaults)
+def create_etcdstat(*args, **kwargs):
+    etcdstat = EtcdStat(*args, **kwargs)
     try:
         yield etcdstat
     finally:
@@ -28,13 +28,13 @@ class Memory(module.BaseModule):
 
     def get(self, key):
         if key == "memory_usage_pct":
-            mem = psutil.virtual_memory()
+            mem = self.sample("virtual_memory", psutil.virtual_memory)
             return 1 - float(mem.available) / mem.total
         elif key == "total_memory":
-            mem = psutil.virtual_memory()
+            mem = self.sample("virtual_memory", psutil.virtual_memory)
             return float(mem.total)
         elif key == "available_memory":
-            mem = psutil.virtual_memory()
+            mem = self.sample("virtual_memory", psutil.virtual_memory)
             return float(mem.available)
         else:
             raise KeyError()
\ No newline at end of file
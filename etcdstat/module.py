@@ -12,8 +12,73 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import threading
+
+class _Pending(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+
+_missing = object()
+
+class Snapshot(object):
+
+    """
+    Tick-scoped cache of probe results. Every probe (identified by its key,
+    e.g. the disk path or the unit name) runs at most once between two
+    calls to clear(), so that all templates rendered in one tick read
+    the same values. A thread asking for a probe which another thread
+    is running (see sampling.py) waits for its result.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.values = {}
+        # the counters of the current tick
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, probe, *args):
+        values = self.values
+        while True:
+            value = values.get(key, _missing)
+            if value is _missing:
+                with self.lock:
+                    if key not in values:
+                        pending = values[key] = _Pending()
+                        break
+                continue
+            if not isinstance(value, _Pending):
+                self.hits += 1
+                return value
+            value.done.wait()
+        self.misses += 1
+        try:
+            value = values[key] = probe(*args)
+        except:
+            # the next caller tries again
+            with self.lock:
+                del values[key]
+            raise
+        finally:
+            pending.done.set()
+        return value
+
 class BaseModule(object):
 
+    snapshot = None
+    # the keys whose values are functions without side effects, which
+    # may be called ahead of rendering (see sampling.py)
+    probes = ()
+
     def provides(self, key):
         return key in self.keys()
 
+    def sample(self, key, probe, *args):
+        if self.snapshot is None:
+            return probe(*args)
+        return self.snapshot.get((self.__class__.__name__, key), probe, *args)
+
@@ -32,13 +32,16 @@ class OS(module.BaseModule):
         hostname1 = bus.get_object(OS.HOSTNAME, "/org/freedesktop/hostname1")
         return dbus.Interface(hostname1, dbus_interface="org.freedesktop.DBus.Properties")
 
+    def os_name(self):
+        return self.hostname_props().Get("org.freedesktop.hostname1", "OperatingSystemPrettyName")
+
     def keys(self):
         return ["os_name"]
 
     def get(self, key):
         if key == "os_name":
             try:
-                return self.hostname_props().Get("org.freedesktop.hostname1", "OperatingSystemPrettyName")
+                return self.sample("os_name", self.os_name)
             except dbus.DBusException:
                 logging.error("Error getting OS name", exc_info=True)
                 return ""
@@ -0,0 +1,137 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import sys
+import threading
+import Queue
+import scheduler
+import templates
+
+def describe(key):
+    return key if isinstance(key, basestring) else templates.describe(key)
+
+class Task(object):
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except:
+            self.error = sys.exc_info()
+        finally:
+            self.done.set()
+
+class SamplerThread(threading.Thread):
+
+    def __init__(self, queue):
+        super(SamplerThread, self).__init__()
+        self.queue = queue
+        self.daemon = True
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            task.run()
+
+class Sampler(object):
+
+    """
+    Evaluates the context keys and the calls needed by a tick concurrently
+    in a pool of `workers` threads, so that one hung probe (e.g. a D-Bus
+    call) doesn't hold up the others. Whatever isn't done `deadline`
+    seconds after the start of the tick is reported as missed, and the
+    items depending on it are skipped for that tick. A probe that is
+    still running from an earlier tick isn't started again until it
+    returns.
+
+    The calls (see templates.calls()) are evaluated as whole chains, e.g.
+    `unit("x").properties.ActiveState`, so that the D-Bus calls and the
+    cgroup reads behind them are made by the pool too. Their probes are
+    memoized in the tick's snapshot, from which rendering then reads the
+    same values. A call which fails is logged and reported as missed.
+    """
+
+    def __init__(self, env, workers=4, deadline=1.0):
+        self.env = env
+        self.deadline = deadline
+        self.queue = Queue.Queue()
+        self.threads = [SamplerThread(self.queue) for i in xrange(workers)]
+        for thread in self.threads:
+            thread.start()
+        self.running = {}
+        self.expressions = {}
+
+    def submit(self, key, func, *args):
+        task = self.running.get(key)
+        if task is not None and not task.done.is_set():
+            logging.debug("Sampling %s is still running" % describe(key))
+            return None
+        task = self.running[key] = Task(func, args)
+        self.queue.put(task)
+        return task
+
+    def expression(self, spec):
+        try:
+            return self.expressions[spec]
+        except KeyError:
+            expr = self.expressions[spec] = templates.expression(spec, self.env)
+            return expr
+
+    def evaluate(self, context, keys, calls):
+        """
+        Return (ctx, missed): the dict of the values of the given keys
+        provided by the context, and the set of the keys and calls which
+        failed or missed the deadline.
+        """
+        end = scheduler.monotonic() + self.deadline
+        tasks = {}
+        for key in keys:
+            if context.provides(key):
+                tasks[key] = self.submit(key, context.__getitem__, key)
+        for spec in calls:
+            name = templates.root(spec)
+            if context.is_probe(name):
+                tasks[spec] = self.submit(spec, self.call, context, name, spec)
+
+        ctx = {}
+        missed = set()
+        for key, task in tasks.iteritems():
+            if task is None or not task.done.wait(max(end - scheduler.monotonic(), 0)):
+                missed.add(key)
+                continue
+            del self.running[key]
+            if task.error is not None:
+                logging.error("Error sampling %s" % describe(key), exc_info=task.error)
+                missed.add(key)
+            elif key in keys:
+                ctx[key] = task.result
+        if missed:
+            logging.warning("Sampling missed the deadline or failed: %s" % ", ".join(sorted(describe(key) for key in missed)))
+        return (ctx, missed)
+
+    def call(self, context, name, spec):
+        return self.expression(spec)({ name : context[name] })
+
+    def close(self):
+        for thread in self.threads:
+            self.queue.put(None)
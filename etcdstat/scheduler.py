@@ -0,0 +1,134 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import heapq
+import logging
+import time
+
+def _monotonic_clock():
+    try:
+        return time.monotonic
+    except AttributeError:
+        pass
+    try:
+        import ctypes
+        import ctypes.util
+        import os
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1
+
+        def monotonic():
+            t = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return t.tv_sec + t.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except (AttributeError, OSError, TypeError):
+        logging.warning("Monotonic clock is not available, using the wall clock")
+        return time.time
+
+monotonic = _monotonic_clock()
+
+def phase(key, interval):
+    """
+    Return a stable offset in [0, interval) derived from the given key
+    (e.g. the instance name), so that the hosts of a fleet spread their
+    ticks over the interval.
+    """
+    import zlib
+    return (zlib.crc32(key) & 0xffffffff) / float(1 << 32) * interval
+
+class Scheduler(object):
+
+    """
+    Schedules items with individual intervals. The items sharing an
+    interval form a group, and the groups are kept in a heap ordered by
+    the time they are due next. pop_due() returns the items of all the
+    groups which are due (within `slack` seconds), so that they are
+    rendered and published in one batch.
+
+    Deadlines are kept on a fixed grid (start + n*interval) of the
+    monotonic clock, so the time spent in a tick doesn't shift the next
+    ones. If a group falls behind by a whole interval or more, the missed
+    ticks are skipped and counted in `overruns`.
+    """
+
+    def __init__(self, slack=0.05):
+        self.groups = {}
+        self.heap = []
+        self.slack = slack
+        self.overruns = 0
+        # all the intervals are stretched by this factor (see Backoff)
+        self.factor = 1.0
+
+    def add(self, item, interval):
+        self.groups.setdefault(interval, []).append(item)
+
+    def start(self, now):
+        self.heap = [(now, interval) for interval in self.groups]
+        heapq.heapify(self.heap)
+
+    def next_deadline(self):
+        """
+        Return the time the next group is due, or None if there are none.
+        """
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now + self.slack:
+            (deadline, interval) = heapq.heappop(self.heap)
+            due.extend(self.groups[interval])
+            stretched = interval * self.factor
+            deadline += stretched
+            if deadline <= now:
+                # don't try to catch up with the missed deadlines
+                missed = int((now - deadline) // stretched) + 1
+                deadline += missed * stretched
+                self.overruns += missed
+                logging.warning("Skipped %d ticks of the items polled every %g sec" % (missed, interval))
+            heapq.heappush(self.heap, (deadline, interval))
+        return due
+
+class Backoff(object):
+
+    """
+    AIMD control of the interval stretch factor: when the writes get slower
+    than `latency` seconds on average or more than `error_rate` of them
+    fail, the factor is doubled (up to `max_factor`); when they are healthy
+    again, it is decreased by `step` back to 1.
+    """
+
+    def __init__(self, max_factor=8.0, latency=1.0, error_rate=0.1, step=0.25):
+        self.max_factor = max_factor
+        self.latency = latency
+        self.error_rate = error_rate
+        self.step = step
+        self.factor = 1.0
+
+    def update(self, latency, error_rate):
+        if latency > self.latency or error_rate > self.error_rate:
+            self.factor = min(self.factor * 2, self.max_factor)
+        else:
+            self.factor = max(self.factor - self.step, 1.0)
+        return self.factor
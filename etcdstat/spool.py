@@ -0,0 +1,136 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import collections
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+
+class Spool(object):
+
+    """
+    Bounded on-disk spool of the values which couldn't be written, keeping
+    only the latest value of every key. Updates are appended to a log of
+    length-prefixed JSON records ([name, value], value null for a removed
+    key), which is read back through mmap on startup. Once the log grows
+    over `max_size` bytes it is compacted to the live entries; if it is
+    still too large, the oldest keys are dropped.
+    """
+
+    HEADER = struct.Struct(">I")
+
+    def __init__(self, path, max_size=1024*1024):
+        self.path = path
+        self.max_size = max_size
+        self.values = collections.OrderedDict()
+        self.fp = None
+        self.load()
+        self.compact()
+
+    def __len__(self):
+        return len(self.values)
+
+    def load(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, "rb") as fp:
+            buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                pos = 0
+                while pos + self.HEADER.size <= len(buf):
+                    (length,) = self.HEADER.unpack_from(buf, pos)
+                    pos += self.HEADER.size
+                    if pos + length > len(buf):
+                        logging.warning("Truncated record in spool %s" % self.path)
+                        break
+                    try:
+                        (name, value) = json.loads(buf[pos:pos+length])
+                    except ValueError:
+                        logging.warning("Corrupted record in spool %s" % self.path)
+                        break
+                    pos += length
+                    self.values.pop(name, None)
+                    if value is not None:
+                        self.values[name] = value
+            finally:
+                buf.close()
+        if self.values:
+            logging.info("Loaded %d spooled values from %s" % (len(self.values), self.path))
+
+    def record(self, name, value):
+        data = json.dumps([name, value])
+        return self.HEADER.pack(len(data)) + data
+
+    def compact(self):
+        if self.fp is not None:
+            self.fp.close()
+        records = []
+        size = 0
+        full = False
+        for name, value in reversed(self.values.items()):
+            record = self.record(name, value)
+            if full or size + len(record) > self.max_size:
+                logging.warning("Spool %s is full, dropping %s" % (self.path, name))
+                del self.values[name]
+                full = True
+                continue
+            records.append(record)
+            size += len(record)
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as fp:
+            for record in reversed(records):
+                fp.write(record)
+        os.rename(tmp, self.path)
+        self.fp = open(self.path, "ab")
+
+    def put(self, items):
+        """
+        Spool the given (name, value) pairs.
+        """
+        for name, value in items:
+            if self.values.get(name) == value:
+                continue
+            self.values.pop(name, None)
+            self.values[name] = value
+            self.fp.write(self.record(name, value))
+        self.fp.flush()
+        if self.fp.tell() > self.max_size:
+            self.compact()
+
+    def discard(self, names):
+        """
+        Remove the given keys (once they have been written).
+        """
+        changed = False
+        for name in names:
+            if name in self.values:
+                del self.values[name]
+                self.fp.write(self.record(name, None))
+                changed = True
+        if changed:
+            self.fp.flush()
+            if not self.values:
+                self.compact()
+
+    def take(self, count):
+        """
+        Return up to `count` oldest spooled (name, value) pairs.
+        """
+        return list(itertools.islice(self.values.iteritems(), count))
+
+    def close(self):
+        self.fp.close()
@@ -16,40 +16,231 @@ import dbus
 import module
 import logging
 import cachetools
+import os
 import psutil
+import scheduler
+import threading
+
+# whether the D-Bus signals are delivered (see start_main_loop())
+signals = False
+
+def start_main_loop():
+    """
+    Run the GLib main loop delivering the D-Bus signals in a daemon thread.
+    """
+    global signals
+    try:
+        from gi.repository import GLib
+    except ImportError:
+        try:
+            import gobject as GLib
+            GLib.threads_init()
+        except ImportError:
+            logging.warning("GLib is not available, the D-Bus signals won't be received")
+            return
+    import dbus.mainloop.glib
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    thread = threading.Thread(target=GLib.MainLoop().run)
+    thread.daemon = True
+    thread.start()
+    signals = True
+
+# the errors meaning that the connection or the object is gone, as
+# opposed to the errors of a single call (e.g. NoSuchUnit, UnknownProperty)
+CONNECTION_ERRORS = frozenset([
+    "org.freedesktop.DBus.Error.Disconnected",
+    "org.freedesktop.DBus.Error.NoReply",
+    "org.freedesktop.DBus.Error.ServiceUnknown",
+    "org.freedesktop.DBus.Error.UnknownObject",
+])
+
+def _connection_error(e):
+    return e.get_dbus_name() in CONNECTION_ERRORS
+
+EMITS_CHANGED_SIGNAL = "org.freedesktop.DBus.Property.EmitsChangedSignal"
+
+def _signalled(xml, interface):
+    """
+    Return the names of the properties of the interface described by the
+    introspection data which are announced by PropertiesChanged (with
+    their values or as invalidated), or never change.
+    """
+    from xml.etree import ElementTree
+    result = set()
+    for iface in ElementTree.fromstring(xml).findall("interface"):
+        if iface.get("name") != interface:
+            continue
+        default = "true"
+        for annotation in iface.findall("annotation"):
+            if annotation.get("name") == EMITS_CHANGED_SIGNAL:
+                default = annotation.get("value")
+        for prop in iface.findall("property"):
+            emits = default
+            for annotation in prop.findall("annotation"):
+                if annotation.get("name") == EMITS_CHANGED_SIGNAL:
+                    emits = annotation.get("value")
+            if emits != "false":
+                result.add(prop.get("name"))
+    return frozenset(result)
 
 class PropWrapper(object):
 
-    def __init__(self, interface, props):
+    """
+    The properties of a D-Bus object interface. With a `bus` delivering
+    the signals, they are read with GetAll once and those which are
+    announced by PropertiesChanged (per the introspection data of the
+    interface) are then kept up to date from the signals of the object
+    (`key`, its path). The rest, or all of them without the signals, are
+    read with GetAll once per tick, given a `sample` function (see
+    module.BaseModule.sample).
+    """
+
+    # interface -> the names of the properties announced by the signals
+    signalled = {}
+
+    def __init__(self, interface, props, on_error=None, sample=None, key=None, bus=None, on_change=None):
         self.props = props
         self.interface = interface
+        self.on_error = on_error
+        self.on_change = on_change
+        self.sample = sample
+        self.key = key
+        self.values = None
+        self.version = 0
+        self.match = None
+        if bus is not None and signals:
+            try:
+                self.match = bus.add_signal_receiver(self.changed, signal_name="PropertiesChanged",
+                    dbus_interface="org.freedesktop.DBus.Properties", path=key)
+            except:
+                logging.warning("Can't subscribe to the property changes of %s" % key, exc_info=True)
+
+    def changed(self, interface, changed, invalidated):
+        if interface != self.interface:
+            return
+        self.version += 1
+        values = self.values
+        if values is not None:
+            if invalidated:
+                # read them all again on the next use
+                self.values = None
+            else:
+                values.update(changed)
+        # the listeners read the new values
+        if self.on_change is not None:
+            self.on_change(set(changed) | set(invalidated))
+
+    def get_all(self):
+        return self.props.GetAll(self.interface)
+
+    def is_signalled(self, name):
+        try:
+            return name in PropWrapper.signalled[self.interface]
+        except KeyError:
+            pass
+        try:
+            introspectable = dbus.Interface(self.props.proxy_object,
+                dbus_interface="org.freedesktop.DBus.Introspectable")
+            names = PropWrapper.signalled[self.interface] = _signalled(introspectable.Introspect(), self.interface)
+        except dbus.DBusException:
+            raise
+        except:
+            logging.warning("Can't introspect %s, reading its properties every tick" % self.interface, exc_info=True)
+            names = PropWrapper.signalled[self.interface] = frozenset()
+        return name in names
+
+    def close(self):
+        if self.match is not None:
+            self.match.remove()
+            self.match = None
 
     def __getattr__(self, name):
-        return self.props.Get(self.interface, name)
+        try:
+            if self.match is not None and self.is_signalled(name):
+                values = self.values
+                if values is None:
+                    version = self.version
+                    values = self.get_all()
+                    if version == self.version:
+                        # no change has been missed while reading
+                        self.values = values
+            elif self.sample is not None:
+                values = self.sample(("properties", self.key, self.interface), self.get_all)
+            else:
+                values = None
+            if values is not None and name in values:
+                return values[name]
+            return self.props.Get(self.interface, name)
+        except dbus.DBusException as e:
+            if self.on_error is not None and _connection_error(e):
+                self.on_error()
+            raise
 
 @cachetools.cached(cache=cachetools.LRUCache(5000))
 def _get_process(pid):    
     return psutil.Process(pid=pid)
 
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+def _unified():
+    # the unified (v2) hierarchy is mounted at the root
+    return os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers"))
+
 class CGroupWrapper(object):
 
     """
     * {{...cpu_time_pct}} - percent share of CPU core time by the given cgroup
     * {{...rss}} - total RSS memory in bytes by the given cgroup 
+
+    On the unified (v2) hierarchy, both are read from the cgroup's own
+    accounting (cpu.stat, memory.stat); otherwise they are summed over
+    the processes of the cgroup. With a `sample` function (see
+    module.BaseModule.sample), they are read once per tick. The `usage`
+    dict keeps the last CPU usage reading of the cgroup (see UnitWrapper).
     """
 
-    def __init__(self, cgname):
+    unified = _unified()
+
+    def __init__(self, cgname, sample=None, usage=None):
         self.cgname = cgname
+        self.sample = sample
+        self.usage = usage if usage is not None else {}
+
+    def _sample(self, name, probe):
+        if self.sample is None:
+            return probe()
+        return self.sample(("cgroup", self.cgname, name), probe)
+
+    def _path(self, name):
+        if self.unified:
+            return "%s%s/%s" % (CGROUP_ROOT, self.cgname, name)
+        return "%s/systemd%s/%s" % (CGROUP_ROOT, self.cgname, name)
+
+    def _get_stat(self, name):
+        result = {}
+        with open(self._path(name)) as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) == 2:
+                    result[fields[0]] = int(fields[1])
+        return result
 
     def _get_procs(self):
         result = []
-        with open("/sys/fs/cgroup/systemd%s/cgroup.procs" % self.cgname) as fp:
+        with open(self._path("cgroup.procs")) as fp:
             for pid in fp:
                 result.append(int(pid))
         return result
 
     @property
     def cpu_time_pct(self):
+        return self._sample("cpu_time_pct", self._cpu_time_pct_v2 if self.unified else self._cpu_time_pct_v1)
+
+    @property
+    def rss(self):
+        return self._sample("rss", self._rss)
+
+    def _cpu_time_pct_v1(self):
         procs = self._get_procs()
         cpu_percent = 0.0
         for pid in procs:
@@ -69,8 +260,31 @@ class CGroupWrapper(object):
                 continue
         return float(cpu_percent) / 100
 
-    @property
-    def rss(self):
+    def _cpu_time_pct_v2(self):
+        now = scheduler.monotonic()
+        usage = self._get_stat("cpu.stat")["usage_usec"]
+        last = self.usage.get(self.cgname)
+        self.usage.clear()
+        self.usage[self.cgname] = (now, usage)
+        if last is None or usage < last[1] or now <= last[0]:
+            # like a new psutil.Process, the first reading (or the first
+            # one of a recreated cgroup) is 0
+            return 0.0
+        return (usage - last[1]) / ((now - last[0]) * 1e6)
+
+    def _rss(self):
+        if self.unified:
+            try:
+                stat = self._get_stat("memory.stat")
+                return float(stat["anon"] + stat["file_mapped"])
+            except (IOError, KeyError):
+                pass
+            try:
+                with open(self._path("memory.current")) as fp:
+                    return float(fp.read())
+            except IOError:
+                # the memory controller isn't enabled for the cgroup
+                pass
         procs = self._get_procs()
         memory = 0.0
         for pid in procs:
@@ -90,21 +304,31 @@ class UnitWrapper(object):
     * {{...handle(action)}} - execute unit action (one of start, stop, restart)
     """
 
-    def __init__(self, obj):
+    def __init__(self, obj, on_error=None, sample=None, key=None, bus=None, on_change=None):
         self.unit = dbus.Interface(obj, dbus_interface="org.freedesktop.systemd1.Unit")
         self.props = PropWrapper(
             "org.freedesktop.systemd1.Unit", 
-            dbus.Interface(obj, dbus_interface="org.freedesktop.DBus.Properties"))
+            dbus.Interface(obj, dbus_interface="org.freedesktop.DBus.Properties"), on_error, sample, key, bus,
+            on_change)
         self.service_props = PropWrapper(
             "org.freedesktop.systemd1.Service",
-            dbus.Interface(obj, dbus_interface="org.freedesktop.DBus.Properties"))
-        self.cgroup = CGroupWrapper(str(self.service_props.ControlGroup))
+            dbus.Interface(obj, dbus_interface="org.freedesktop.DBus.Properties"), on_error, sample, key, bus)
+        self.sample = sample
+        # the last CPU usage reading of the unit's cgroup
+        self.usage = {}
+
+    def close(self):
+        self.props.close()
+        self.service_props.close()
+
+    @property
+    def cgroup(self):
+        # looked up on every use: the cgroup changes as the unit starts and stops
+        return CGroupWrapper(str(self.service_props.ControlGroup), self.sample, self.usage)
 
     def __getattr__(self, name):
         if name == "properties":
             return self.props
-        elif name == "cgroup":
-            return self.cgroup
         elif name == "handle":
             def handle(action):
                 if action == "start":
@@ -124,40 +348,129 @@ class Systemd(module.BaseModule):
 
     """
     * {{unit(name)}} - get the systemd unit object (see UnitWrapper)
+
+    The module keeps one connection to the system bus and caches the unit
+    objects by name. When the main loop is running (see start_main_loop()),
+    the unit properties are kept up to date from the signals (see
+    PropWrapper), and a unit is dropped from the cache when systemd
+    announces it is loaded or unloaded (UnitNew/UnitRemoved). A unit is
+    also dropped when its object is gone; the connection is dropped when
+    it is lost (see CONNECTION_ERRORS).
     """    
 
     SYSTEMD = "org.freedesktop.systemd1"
 
+    probes = ("unit",)
+
+    STATE = frozenset(["ActiveState", "SubState"])
+
     def __init__(self):
-        pass  
+        self.lock = threading.Lock()
+        self.connection = None
+        self.units = {}
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """
+        Call listener(name) (in the main loop thread) whenever the
+        ActiveState or SubState of a unit in use changes.
+        """
+        self.listeners.append(listener)
+
+    def state_changed(self, name, properties):
+        if properties & Systemd.STATE:
+            for listener in self.listeners:
+                listener(name)
+
+    def connect(self):
+        with self.lock:
+            if self.connection is None:
+                bus = dbus.SystemBus(private=True)
+                systemd1 = bus.get_object(Systemd.SYSTEMD, "/org/freedesktop/systemd1")
+                manager = dbus.Interface(systemd1, dbus_interface="org.freedesktop.systemd1.Manager")
+                props = PropWrapper("org.freedesktop.systemd1.Manager", 
+                    dbus.Interface(systemd1, dbus_interface="org.freedesktop.DBus.Properties"), self.disconnect,
+                    self.sample, "/org/freedesktop/systemd1", bus)
+                if signals:
+                    try:
+                        for signal in ["UnitNew", "UnitRemoved"]:
+                            bus.add_signal_receiver(self.unit_changed, signal_name=signal,
+                                dbus_interface="org.freedesktop.systemd1.Manager", path="/org/freedesktop/systemd1")
+                        manager.Subscribe()
+                    except:
+                        logging.warning("Can't subscribe to the systemd signals", exc_info=True)
+                self.units = {}
+                self.connection = (bus, manager, props)
+            return self.connection
+
+    def disconnect(self):
+        with self.lock:
+            if self.connection is not None:
+                try:
+                    self.connection[0].close()
+                except:
+                    pass
+            self.connection = None
+            self.units = {}
+
+    def call(self, method, *args):
+        try:
+            return getattr(self.manager(), method)(*args)
+        except dbus.DBusException as e:
+            if _connection_error(e):
+                self.disconnect()
+            raise
+
+    def unit_changed(self, name, path):
+        self.drop(str(name))
+
+    def drop(self, name):
+        with self.lock:
+            unit = self.units.pop(name, None)
+        if unit is not None:
+            unit.close()
 
     def bus(self):
-        return dbus.SystemBus()
+        return self.connect()[0]
 
     def manager(self):        
-        systemd1 = self.bus().get_object(Systemd.SYSTEMD, "/org/freedesktop/systemd1")
-        return dbus.Interface(systemd1, dbus_interface="org.freedesktop.systemd1.Manager")
+        return self.connect()[1]
 
     def manager_props(self):
-        systemd1 = self.bus().get_object(Systemd.SYSTEMD, "/org/freedesktop/systemd1")
-        return PropWrapper("org.freedesktop.systemd1.Manager", 
-            dbus.Interface(systemd1, dbus_interface="org.freedesktop.DBus.Properties"))
+        return self.connect()[2]
 
     def keys(self):
         return ["unit" ,"reboot", "boot_time"]
 
+    def unit(self, name):
+        try:
+            return self.units[name]
+        except KeyError:
+            pass
+        unit_path = self.call("GetUnit", name)
+        bus = self.bus()
+        unit_obj = bus.get_object(Systemd.SYSTEMD, unit_path)
+        with self.lock:
+            # another thread may have created it meanwhile (see sampling.py)
+            if name in self.units:
+                return self.units[name]
+            unit = self.units[name] = UnitWrapper(unit_obj, lambda: self.drop(name),
+                self.sample, str(unit_path), bus, lambda properties: self.state_changed(name, properties))
+            return unit
+
+    def boot_time(self):
+        return self.manager_props().KernelTimestamp/1000000.0
+
     def get(self, key):
         if key == "unit":
             def unit(name):
-                unit_path = self.manager().GetUnit(name)
-                unit_obj = self.bus().get_object(Systemd.SYSTEMD, unit_path)
-                return UnitWrapper(unit_obj)
+                return self.sample(("unit", name), self.unit, name)
             return unit
         elif key == "reboot":
             def reboot():
-                self.manager().Reboot()
+                self.call("Reboot")
             return reboot
         elif key == "boot_time":
-            return self.manager_props().KernelTimestamp/1000000.0
+            return self.sample("boot_time", self.boot_time)
         else:
             raise KeyError(key)
@@ -0,0 +1,326 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Fast path for trivial templates.
+
+Most items are text with simple substitutions like `{{cpu}}`,
+`{{available_storage("/")}}` or `/tw/cluster/stats/{{instance}}/cpu`.
+analyze() recognizes such templates in the jinja2 AST and describes them
+with a spec made of plain tuples:
+
+* ("const", text)
+* ("name", name)
+* ("getattr", spec, attribute)
+* ("call", spec, (arg, ...)) - with constant arguments only
+* ("output", (spec, ...)) - the template itself
+
+build() turns a spec into a function of the context dict which renders
+the same text as jinja2 would, without the jinja2 render machinery.
+"""
+
+import logging
+import os
+import pickle
+from jinja2 import nodes
+
+def _expr(node):
+    if isinstance(node, nodes.Name) and node.ctx == "load":
+        return ("name", node.name)
+    elif isinstance(node, nodes.Getattr):
+        spec = _expr(node.node)
+        return ("getattr", spec, node.attr) if spec else None
+    elif isinstance(node, nodes.Call):
+        if node.kwargs or node.dyn_args or node.dyn_kwargs:
+            return None
+        if not all(isinstance(arg, nodes.Const) for arg in node.args):
+            return None
+        spec = _expr(node.node)
+        return ("call", spec, tuple(arg.value for arg in node.args)) if spec else None
+    else:
+        return None
+
+def analyze(ast):
+    """
+    Return the spec of the template, or None if it isn't trivial.
+    """
+    if len(ast.body) > 1 or (ast.body and not isinstance(ast.body[0], nodes.Output)):
+        return None
+    parts = []
+    for output in ast.body:
+        for node in output.nodes:
+            if isinstance(node, nodes.TemplateData):
+                parts.append(("const", node.data))
+            else:
+                spec = _expr(node)
+                if spec is None:
+                    return None
+                parts.append(spec)
+    return ("output", tuple(parts))
+
+def _probe(spec):
+    if spec[0] == "getattr":
+        return _probe(spec[1])
+    return spec[0] == "call" and spec[1][0] == "name"
+
+def calls(ast):
+    """
+    Return the specs of the expressions of the template which call a
+    context function with constant arguments, followed by attribute
+    lookups only, e.g. `available_storage("/")` or
+    `unit("etcd.service").properties.ActiveState`. Those can be
+    evaluated ahead of rendering (see sampling.py).
+    """
+    result = set()
+    def visit(node):
+        if isinstance(node, (nodes.Call, nodes.Getattr)):
+            spec = _expr(node)
+            if spec is not None and _probe(spec):
+                result.add(spec)
+                return
+        for child in node.iter_child_nodes():
+            visit(child)
+    visit(ast)
+    return frozenset(result)
+
+def root(spec):
+    """
+    Return the name of the context function called by the expression.
+    """
+    while spec[0] != "name":
+        spec = spec[1]
+    return spec[1]
+
+def arguments(spec):
+    """
+    Return the arguments the expression calls the context function with.
+    """
+    while spec[0] == "getattr":
+        spec = spec[1]
+    return spec[2]
+
+def describe(spec):
+    """
+    Return the source text of the expression (for the logs).
+    """
+    kind = spec[0]
+    if kind == "name":
+        return spec[1]
+    elif kind == "getattr":
+        return "%s.%s" % (describe(spec[1]), spec[2])
+    else:
+        return "%s(%s)" % (describe(spec[1]), ", ".join(repr(arg) for arg in spec[2]))
+
+def expression(spec, env):
+    """
+    Return the function of the context dict evaluating the expression.
+    """
+    return _build(spec, env)
+
+def _build(spec, env):
+    kind = spec[0]
+    if kind == "name":
+        name = spec[1]
+        env_globals = env.globals
+        undefined = env.undefined
+        def resolve(ctx):
+            try:
+                return ctx[name]
+            except KeyError:
+                pass
+            try:
+                return env_globals[name]
+            except KeyError:
+                return undefined(name=name)
+        return resolve
+    elif kind == "getattr":
+        obj = _build(spec[1], env)
+        attr = spec[2]
+        getattr = env.getattr
+        return lambda ctx: getattr(obj(ctx), attr)
+    elif kind == "call":
+        func = _build(spec[1], env)
+        args = spec[2]
+        return lambda ctx: func(ctx)(*args)
+    else:
+        raise ValueError("Unsupported spec: %r" % (spec,))
+
+def _part(spec, env):
+    if spec[0] == "const":
+        text = unicode(spec[1])
+        return lambda ctx: text
+    expr = _build(spec, env)
+    return lambda ctx: unicode(expr(ctx))
+
+def build(spec, env):
+    """
+    Return the function rendering the template described by the spec.
+    """
+    parts = [_part(part, env) for part in spec[1]]
+    if not parts:
+        return lambda ctx: u""
+    if len(parts) == 1:
+        return parts[0]
+    return lambda ctx: u"".join([part(ctx) for part in parts])
+
+def _code(spec):
+    kind = spec[0]
+    if kind == "name":
+        return "(ctx[%r] if %r in ctx else _missing(%r))" % (spec[1], spec[1], spec[1])
+    elif kind == "getattr":
+        return "_getattr(%s, %r)" % (_code(spec[1]), spec[2])
+    elif kind == "call":
+        return "%s(%s)" % (_code(spec[1]), "".join("%r, " % arg for arg in spec[2]))
+    else:
+        raise ValueError("Unsupported spec: %r" % (spec,))
+
+def _output_code(spec):
+    parts = ["%r" % unicode(part[1]) if part[0] == "const" else "_unicode(%s)" % _code(part) for part in spec[1]]
+    if not parts:
+        return "u''"
+    if len(parts) == 1:
+        return parts[0]
+    return "u''.join((%s))" % "".join("%s, " % part for part in parts)
+
+def compile_program(items, env):
+    """
+    Compile all the items into one function
+
+        program(ctx, due, names, fail) -> [(item, name, value), ...]
+
+    rendering the `due` items in a single pass over the context dict `ctx`.
+    `items` is a list of (item, name template, value template, static):
+    the name of a static item is taken from (and stored to) the `names`
+    dict. Trivial templates are inlined as Python expressions, the rest
+    are rendered by their jinja2 render functions in one context shared
+    by the whole pass. A template which fails is reported as
+    fail(template) and its item is skipped.
+    """
+    templates = []
+    def expr(template):
+        templates.append(template)
+        if template.spec is not None:
+            return _output_code(template.spec)
+        return "_concat(_root[%d](_new_context[%d](parent, shared=True)))" % (len(templates) - 1, len(templates) - 1)
+
+    body = []
+    for k, (p, name, value, static) in enumerate(items):
+        n = len(templates)
+        body += [
+            "    if _items[%d] in due:" % k,
+            "        try:",
+        ]
+        if static:
+            body += [
+                "            if _items[%d] in names:" % k,
+                "                n = names[_items[%d]]" % k,
+                "            else:",
+                "                n = names[_items[%d]] = %s" % (k, expr(name)),
+            ]
+        else:
+            body += [
+                "            n = %s" % expr(name),
+            ]
+        body += [
+            "        except:",
+            "            fail(_templates[%d])" % n,
+            "        else:",
+            "            try:",
+            "                v = %s" % expr(value),
+            "            except:",
+            "                fail(_templates[%d])" % (n + 1),
+            "            else:",
+            "                result.append((_items[%d], n, v))" % k,
+        ]
+
+    lines = [
+        "def program(ctx, due, names, fail):",
+        "    result = []",
+    ]
+    if any(t.spec is None for t in templates):
+        # what Template.render() does for every template, once per pass
+        lines.append("    parent = dict(_globals, **ctx)")
+    source = "\n".join(lines + body + ["    return result"]) + "\n"
+
+    env_globals = env.globals
+    undefined = env.undefined
+
+    def _missing(name):
+        try:
+            return env_globals[name]
+        except KeyError:
+            return undefined(name=name)
+
+    namespace = {
+        "_items": [p for (p, name, value, static) in items],
+        "_templates": templates,
+        "_root": [t.template.root_render_func for t in templates],
+        "_new_context": [t.template.new_context for t in templates],
+        "_globals": env_globals,
+        "_concat": u"".join,
+        "_unicode": unicode,
+        "_getattr": env.getattr,
+        "_missing": _missing,
+    }
+    exec compile(source, "<etcdstat program>", "exec") in namespace
+    return namespace["program"]
+
+class AnalysisCache(object):
+
+    """
+    On-disk cache of what compile_template() learns from the jinja2 AST
+    of every template (its variables, spec and calls), so that a restart with
+    the same config doesn't parse the templates again. The compiled code
+    itself is cached by jinja2's FileSystemBytecodeCache. The file is
+    keyed by the hash of all the template sources of the config.
+    """
+
+    # bumped whenever the cached analysis changes
+    VERSION = 4
+
+    def __init__(self, directory, sources):
+        import hashlib
+        digest = hashlib.sha1(str(self.VERSION))
+        for source in sorted(set(sources)):
+            digest.update(source.encode("utf-8") if isinstance(source, unicode) else source)
+            digest.update("\0")
+        self.path = os.path.join(directory, "analysis-%s.pickle" % digest.hexdigest())
+        self.values = {}
+        self.hits = 0
+        self.changed = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "rb") as fp:
+                    self.values = pickle.load(fp)
+            except Exception:
+                logging.warning("Ignoring the unreadable template cache %s" % self.path, exc_info=True)
+
+    def get(self, source):
+        result = self.values.get(source)
+        if result is not None:
+            self.hits += 1
+        return result
+
+    def put(self, source, value):
+        self.values[source] = value
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as fp:
+            pickle.dump(self.values, fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path)
+        self.changed = False
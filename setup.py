@@ -27,6 +27,7 @@ setup(
     cmdclass=versioneer.get_cmdclass(),
     name = "tw-etcdstat",
     packages = ["etcdstat", "etcdstat.etcdparser"],
+    test_suite = "tests",
     entry_points = {
         "console_scripts": ['etcdstat = etcdstat.etcdstat:main']
     },
@@ -40,7 +41,8 @@ setup(
         "jinja2",
         "psutil",
         "cachetools<4.0",
-        "python-etcd"
+        "python-etcd",
+        "urllib3"
     ],
     license="Apache2"
 )
@@ -0,0 +1,91 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import unittest
+from etcdstat.etcdstat import ChangeFilter, Packer
+
+class TestChangeFilter(unittest.TestCase):
+
+    def test_new_key(self):
+        self.assertTrue(ChangeFilter(refresh=0).changed("/a", "1"))
+
+    def test_unchanged(self):
+        f = ChangeFilter(refresh=0)
+        f.update([("/a", "1")])
+        self.assertFalse(f.changed("/a", "1"))
+        self.assertTrue(f.changed("/a", "2"))
+
+    def test_deadband(self):
+        f = ChangeFilter(refresh=0)
+        f.update([("/cpu", "0.50"), ("/os", "linux")])
+        self.assertFalse(f.changed("/cpu", "0.51", 0.02))
+        self.assertTrue(f.changed("/cpu", "0.53", 0.02))
+        self.assertTrue(f.changed("/os", "bsd", 0.02))
+
+    def test_refresh(self):
+        f = ChangeFilter(refresh=3)
+        f.update([("/a", "1")])
+        self.assertFalse(f.changed("/a", "1"))
+        self.assertFalse(f.changed("/a", "1"))
+        self.assertTrue(f.changed("/a", "1"))
+        f.update([("/a", "1")])
+        self.assertFalse(f.changed("/a", "1"))
+
+    def test_failed(self):
+        f = ChangeFilter(refresh=0)
+        f.update([("/a", "1"), ("/b", "1")], failed=[("/b", "1")])
+        self.assertFalse(f.changed("/a", "1"))
+        self.assertTrue(f.changed("/b", "1"))
+
+    def test_clear(self):
+        f = ChangeFilter(refresh=0)
+        f.update([("/a", "1")])
+        f.clear()
+        self.assertTrue(f.changed("/a", "1"))
+
+class TestPacker(unittest.TestCase):
+
+    def test_document(self):
+        packer = Packer()
+        packer.update([("/a/b/cpu", 0.5), ("/a/b/v2/tag", "x")])
+        (name, doc) = packer.document()
+        self.assertEqual(name, "/a/b")
+        self.assertEqual(json.loads(doc), {"cpu": 0.5, "v2": {"tag": "x"}})
+
+    def test_single_key(self):
+        packer = Packer()
+        packer.update([("/a/b/cpu", 0.5)])
+        (name, doc) = packer.document()
+        self.assertEqual(name, "/a/b")
+        self.assertEqual(json.loads(doc), {"cpu": 0.5})
+
+    def test_conflict(self):
+        packer = Packer()
+        packer.update([("/a/b", 1), ("/a/b/c", 2), ("/a/d", 3)])
+        (name, doc) = packer.document()
+        self.assertEqual(name, "/a")
+        self.assertEqual(json.loads(doc), {"b": 1, "d": 3})
+
+    def test_clear(self):
+        packer = Packer()
+        packer.update([("/a/b/cpu", 0.5), ("/a/c/cpu", 0.5)])
+        packer.clear()
+        packer.update([("/a/b/cpu", 0.25), ("/a/b/memory", 0.75)])
+        (name, doc) = packer.document()
+        self.assertEqual(name, "/a/b")
+        self.assertEqual(json.loads(doc), {"cpu": 0.25, "memory": 0.75})
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import threading
+import unittest
+from jinja2 import Environment
+from etcdstat import module
+from etcdstat import sampling
+from etcdstat import templates
+from etcdstat.etcdstat import Context
+
+class Props(object):
+
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+    def __getattr__(self, attr):
+        values = self.module.sample(("properties", self.name), self.module.get_all, self.name)
+        return values[attr]
+
+class Unit(object):
+
+    def __init__(self, module, name):
+        self.properties = Props(module, name)
+
+class Units(module.BaseModule):
+
+    probes = ("unit",)
+
+    def __init__(self):
+        self.calls = []
+        self.hung = threading.Event()
+
+    def keys(self):
+        return ["unit"]
+
+    def get_all(self, name):
+        self.calls.append(name)
+        if name == "hung":
+            self.hung.wait()
+        return {"ActiveState": "active", "SubState": "running"}
+
+    def get(self, key):
+        return lambda name: Unit(self, name)
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_tick(self):
+        snapshot = module.Snapshot()
+        probe = lambda: object()
+        value = snapshot.get("a", probe)
+        self.assertIs(snapshot.get("a", probe), value)
+        self.assertEqual((snapshot.hits, snapshot.misses), (1, 1))
+        snapshot.clear()
+        self.assertEqual((snapshot.hits, snapshot.misses), (0, 0))
+        self.assertIsNot(snapshot.get("a", probe), value)
+
+    def test_error(self):
+        snapshot = module.Snapshot()
+        def fail():
+            raise IOError()
+        self.assertRaises(IOError, snapshot.get, "a", fail)
+        self.assertEqual(snapshot.get("a", lambda: 1), 1)
+
+class TestSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.env = Environment()
+        self.units = Units()
+        self.context = Context()
+        self.context.add_module(self.units)
+        self.sampler = sampling.Sampler(self.env, workers=4, deadline=0.2)
+
+    def tearDown(self):
+        self.units.hung.set()
+        self.sampler.close()
+
+    def calls(self, source):
+        return templates.calls(self.env.parse(source))
+
+    def test_chains(self):
+        calls = self.calls("{{unit('a').properties.ActiveState}} {{unit('a').properties.SubState}}")
+        self.context.snapshot.clear()
+        (ctx, missed) = self.sampler.evaluate(self.context, set(), calls)
+        self.assertEqual(missed, set())
+        # the probe ran once, in the pool, and rendering reads its result
+        self.assertEqual(self.units.calls, ["a"])
+        template = self.env.from_string("{{unit('a').properties.SubState}}")
+        self.assertEqual(template.render(unit=self.context["unit"]), "running")
+        self.assertEqual(self.units.calls, ["a"])
+
+    def test_deadline(self):
+        calls = self.calls("{{unit('a').properties.ActiveState}} {{unit('hung').properties.ActiveState}}")
+        self.context.snapshot.clear()
+        (ctx, missed) = self.sampler.evaluate(self.context, set(), calls)
+        self.assertEqual([templates.describe(spec) for spec in missed], ["unit(u'hung').properties.ActiveState"])
+        # the hung chain isn't started again until it returns
+        self.context.snapshot.clear()
+        (ctx, missed) = self.sampler.evaluate(self.context, set(), calls)
+        self.assertEqual(len(missed), 1)
+        self.assertEqual(self.units.calls.count("hung"), 1)
+
+    def test_error(self):
+        calls = self.calls("{{unit('a').properties.Missing}}")
+        self.context.snapshot.clear()
+        (ctx, missed) = self.sampler.evaluate(self.context, set(), calls)
+        self.assertEqual(missed, set(calls))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from etcdstat import scheduler
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = scheduler.Scheduler(slack=0.05)
+        self.scheduler.add("cpu", 10)
+        self.scheduler.add("memory", 10)
+        self.scheduler.add("os", 60)
+        self.scheduler.start(100.0)
+
+    def test_groups(self):
+        self.assertEqual(self.scheduler.next_deadline(), 100.0)
+        self.assertEqual(sorted(self.scheduler.pop_due(100.0)), ["cpu", "memory", "os"])
+        self.assertEqual(self.scheduler.next_deadline(), 110.0)
+        self.assertEqual(self.scheduler.pop_due(109.0), [])
+        self.assertEqual(sorted(self.scheduler.pop_due(109.98)), ["cpu", "memory"])
+        for tick in xrange(2, 6):
+            self.assertEqual(sorted(self.scheduler.pop_due(100.0 + tick * 10)), ["cpu", "memory"])
+        self.assertEqual(sorted(self.scheduler.pop_due(160.0)), ["cpu", "memory", "os"])
+
+    def test_grid(self):
+        # a late tick doesn't shift the next deadlines
+        self.scheduler.pop_due(100.0)
+        self.scheduler.pop_due(113.0)
+        self.assertEqual(self.scheduler.next_deadline(), 120.0)
+        self.assertEqual(self.scheduler.overruns, 0)
+
+    def test_overruns(self):
+        self.scheduler.pop_due(100.0)
+        self.assertEqual(sorted(self.scheduler.pop_due(135.0)), ["cpu", "memory"])
+        self.assertEqual(self.scheduler.next_deadline(), 140.0)
+        self.assertEqual(self.scheduler.overruns, 2)
+
+    def test_factor(self):
+        self.scheduler.pop_due(100.0)
+        self.scheduler.factor = 2.0
+        self.scheduler.pop_due(110.0)
+        self.assertEqual(self.scheduler.next_deadline(), 130.0)
+
+    def test_empty(self):
+        empty = scheduler.Scheduler()
+        empty.start(100.0)
+        self.assertIsNone(empty.next_deadline())
+        self.assertEqual(empty.pop_due(200.0), [])
+
+class TestBackoff(unittest.TestCase):
+
+    def test_update(self):
+        backoff = scheduler.Backoff(max_factor=4, latency=1.0, error_rate=0.1, step=0.5)
+        self.assertEqual(backoff.update(0.1, 0), 1.0)
+        self.assertEqual(backoff.update(2.0, 0), 2.0)
+        self.assertEqual(backoff.update(0.1, 0.5), 4.0)
+        self.assertEqual(backoff.update(2.0, 0.5), 4.0)
+        self.assertEqual(backoff.update(0.1, 0), 3.5)
+        for i in xrange(10):
+            backoff.update(0.1, 0)
+        self.assertEqual(backoff.factor, 1.0)
+
+class TestPhase(unittest.TestCase):
+
+    def test_phase(self):
+        self.assertEqual(scheduler.phase("host-1", 10), scheduler.phase("host-1", 10))
+        for host in ["host-%d" % i for i in xrange(100)]:
+            self.assertTrue(0 <= scheduler.phase(host, 10) < 10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+from etcdstat.spool import Spool
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "spool")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_put(self):
+        spool = Spool(self.path)
+        spool.put([("/a", "1"), ("/b", "2"), ("/a", "3")])
+        self.assertEqual(spool.take(10), [("/b", "2"), ("/a", "3")])
+        self.assertEqual(spool.take(1), [("/b", "2")])
+        spool.close()
+
+    def test_discard(self):
+        spool = Spool(self.path)
+        spool.put([("/a", "1"), ("/b", "2")])
+        spool.discard(["/a", "/missing"])
+        self.assertEqual(spool.take(10), [("/b", "2")])
+        spool.discard(["/b"])
+        self.assertEqual(len(spool), 0)
+        self.assertEqual(os.path.getsize(self.path), 0)
+        spool.close()
+
+    def test_reload(self):
+        spool = Spool(self.path)
+        spool.put([("/a", "1"), ("/b", "2"), ("/c", "3")])
+        spool.discard(["/b"])
+        spool.put([("/a", "4")])
+        spool.close()
+        spool = Spool(self.path)
+        self.assertEqual(spool.take(10), [("/c", "3"), ("/a", "4")])
+        spool.close()
+
+    def test_truncated(self):
+        spool = Spool(self.path)
+        spool.put([("/a", "1"), ("/b", "2")])
+        spool.close()
+        with open(self.path, "r+b") as fp:
+            fp.truncate(os.path.getsize(self.path) - 1)
+        spool = Spool(self.path)
+        self.assertEqual(spool.take(10), [("/a", "1")])
+        spool.close()
+
+    def test_compact(self):
+        record = len(Spool.HEADER.pack(0) + '["/k00", "value"]')
+        spool = Spool(self.path, max_size=record * 5)
+        for i in xrange(20):
+            spool.put([("/k%02d" % (i % 3), "value")])
+        self.assertEqual(sorted(name for name, value in spool.take(10)), ["/k00", "/k01", "/k02"])
+        self.assertTrue(os.path.getsize(self.path) <= record * 5)
+        spool.put([("/k%02d" % i, "value") for i in xrange(3, 10)])
+        self.assertEqual([name for name, value in spool.take(10)], ["/k%02d" % i for i in xrange(5, 10)])
+        spool.close()
+
+if __name__ == "__main__":
+    unittest.main()
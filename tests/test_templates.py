@@ -0,0 +1,146 @@
+#    Copyright 2017 Thingswise, LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import unittest
+from jinja2 import Environment
+from etcdstat import templates
+from etcdstat.etcdstat import compile_template
+
+class Obj(object):
+
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+def storage(path):
+    return {"/": 1024, "/data": 0.5}[path]
+
+CONTEXT = {
+    "instance": "host-1",
+    "cpu": 0.25,
+    "count": 3,
+    "nothing": None,
+    "text": u"\u00e9t\u00e9",
+    "obj": Obj(attr="value", nested=Obj(attr=42)),
+    "props": {"ActiveState": "active"},
+    "available_storage": storage,
+    "unit": lambda name: Obj(name=name, properties={"SubState": "running"}),
+}
+
+# trivial templates: text, names, attribute chains and calls
+TRIVIAL = [
+    "",
+    "plain text",
+    "{{instance}}",
+    "/tw/cluster/stats/{{instance}}/cpu",
+    "{{cpu}}",
+    "{{count}}",
+    "{{nothing}}",
+    "{{text}}",
+    "{{instance}}-{{cpu}}-{{text}}",
+    "{{obj.attr}}",
+    "{{obj.nested.attr}}",
+    "{{obj.missing}}",
+    "{{props.ActiveState}}",
+    "{{available_storage('/')}}",
+    "{{available_storage(\"/data\")}}",
+    "{{unit('etcd.service').name}}",
+    "{{unit('etcd.service').properties.SubState}}",
+    "{{missing}}",
+    "a{{missing}}b",
+]
+
+# trivial templates which fail in jinja2 as well
+FAILING = [
+    "{{missing.attr}}",
+    "{{missing()}}",
+    "{{obj.missing.attr}}",
+]
+
+class TestFastPath(unittest.TestCase):
+
+    def setUp(self):
+        self.env = Environment()
+
+    def render(self, source):
+        return self.env.from_string(source).render(CONTEXT)
+
+    def test_trivial(self):
+        for source in TRIVIAL:
+            spec = templates.analyze(self.env.parse(source))
+            self.assertIsNotNone(spec, source)
+            self.assertEqual(templates.build(spec, self.env)(CONTEXT), self.render(source), source)
+
+    def test_failing(self):
+        for source in FAILING:
+            spec = templates.analyze(self.env.parse(source))
+            self.assertIsNotNone(spec, source)
+            with self.assertRaises(Exception) as expected:
+                self.render(source)
+            with self.assertRaises(type(expected.exception)):
+                templates.build(spec, self.env)(CONTEXT)
+
+    def test_not_trivial(self):
+        for source in ["{% if cpu %}x{% endif %}", "{{cpu * 100}}", "{{cpu|round}}",
+                "{{available_storage(path)}}", "{{obj['attr']}}"]:
+            self.assertIsNone(templates.analyze(self.env.parse(source)), source)
+
+    def test_compiled_template(self):
+        for source in TRIVIAL + ["{% if cpu %}{{cpu * 100}}{% endif %}"]:
+            template = compile_template(self.env, source)
+            self.assertEqual(template.render(CONTEXT), self.render(source), source)
+
+    def test_calls(self):
+        ast = self.env.parse("{{unit('a').properties.SubState}} {{available_storage('/')}} "
+            "{{unit('b').handle('restart')}} {{available_storage(path)}}")
+        self.assertEqual(sorted(templates.describe(spec) for spec in templates.calls(ast)),
+            ["available_storage(u'/')", "unit(u'a').properties.SubState", "unit(u'b').handle"])
+
+    def test_root(self):
+        ast = self.env.parse("{{unit('a').properties.SubState}}")
+        (spec,) = templates.calls(ast)
+        self.assertEqual(templates.root(spec), "unit")
+        self.assertEqual(templates.arguments(spec), ("a",))
+
+class TestProgram(unittest.TestCase):
+
+    def test_program(self):
+        env = Environment()
+        sources = [(n, v) for n in ["/{{instance}}/a", "/{{missing.attr}}/b"]
+            for v in TRIVIAL + FAILING + ["{% if cpu %}{{cpu * 100}}{% endif %}"]]
+        items = [(i, compile_template(env, n), compile_template(env, v), False)
+            for (i, (n, v)) in enumerate(sources)]
+        expected = []
+        for (p, name, value, static) in items:
+            try:
+                expected.append((p, name.render(CONTEXT), value.render(CONTEXT)))
+            except Exception:
+                pass
+        failed = []
+        program = templates.compile_program(items, env)
+        result = program(dict(CONTEXT), set(p for (p, n, v, s) in items), {}, failed.append)
+        self.assertEqual(result, expected)
+        self.assertEqual(len(failed), len(items) - len(expected))
+
+    def test_static_names(self):
+        env = Environment()
+        items = [("a", compile_template(env, "/{{instance}}/a"), compile_template(env, "{{cpu}}"), True)]
+        program = templates.compile_program(items, env)
+        names = {}
+        self.assertEqual(program(dict(CONTEXT), set(["a"]), names, None), [("a", u"/host-1/a", u"0.25")])
+        self.assertEqual(names, {"a": u"/host-1/a"})
+        names["a"] = u"/cached/a"
+        self.assertEqual(program(dict(CONTEXT), set(["a"]), names, None), [("a", u"/cached/a", u"0.25")])
+
+if __name__ == "__main__":
+    unittest.main()